@@ -0,0 +1,88 @@
+"""
+Benchmark of bond building (candidate search and bond selection) on synthetic graphene lattices.
+- Single-pass vs. sweeps selection.
+- Incremental update (Bonds.update) vs. rebuild on consecutive frames with position jitter.
+
+Usage (from the root folder of this package):
+    $ python3 ./benchmarks/bench_bonds.py
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+# Import the back-end classes without loading the Nion Swift plug-in itself.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nionswift_plugin', 'atom_manipulator'))
+from classes import atoms_and_bonds as aab
+
+SAMPLING = 0.1 # Angstroem/px
+
+
+# Graphene lattice with Gaussian position noise (in Angstroem) and a fraction of vacancies, in px.
+def graphene_coords(N_sites, noise=0.05, vacancies=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    a = 1.42
+    n = int(np.ceil(np.sqrt(N_sites/2)))
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    origins = np.stack((1.5*a*(i+j), np.sqrt(3)/2*a*(i-j)), axis=-1).reshape(-1, 2)
+    coords = np.concatenate((origins, origins + (a, 0)))[:N_sites]
+    coords = coords + rng.normal(0, noise, coords.shape)
+    coords = coords[rng.random(len(coords)) >= vacancies]
+    return coords/SAMPLING
+
+
+def timed(func, *args, repeat=3):
+    t_min = np.inf
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = func(*args)
+        t_min = min(t_min, time.perf_counter()-t)
+    return t_min, out
+
+
+def sites_of(coords):
+    return [aab.Site(x, y) for x, y in coords]
+
+
+def bond_set(bonds):
+    return set(map(frozenset, bonds.tolist()))
+
+
+def main():
+    # Single pass (default) vs. sweeps. The bond sets are equal (diff 0).
+    print(f"{'sites':>8} {'noise [A]':>9} {'L [A]':>6} {'candidates':>11} {'sweeps [s]':>11} {'single pass [s]':>16} "
+          f"{'speed-up':>9} {'sym. diff.':>11}")
+    for N_sites, noise, L in [(1000, 0.05, 2.2), (5000, 0.05, 2.2), (20000, 0.05, 2.2), (100000, 0.05, 2.2),
+                              (5000, 0.15, 2.2), (5000, 0.05, 2.6)]:
+        coords = graphene_coords(N_sites, noise=noise)
+        pairs = aab.Bonds.candidate_pairs(coords, L/SAMPLING)
+        t_sweeps, bonds_sweeps = timed(aab.Bonds.select_bonds_sweeps, coords, pairs)
+        t_single, bonds_single = timed(aab.Bonds.select_bonds, coords, pairs)
+        diff = len(bond_set(bonds_sweeps) ^ bond_set(bonds_single))
+        print(f"{len(coords):8d} {noise:9.2f} {L:6.1f} {len(pairs):11d} {t_sweeps:11.4f} {t_single:16.4f} "
+              f"{t_sweeps/t_single:9.1f} {diff:11d}")
+
+    # Parity of the incremental update with a rebuild over consecutive frames (see also tests/test_bonds.py).
+    print(f"\n{'sites':>8} {'noise [A]':>9} {'L [A]':>6} {'frames':>7} {'recomputed':>11} {'update [s]':>11} "
+          f"{'rebuild [s]':>12} {'sym. diff.':>11}")
+    rng = np.random.default_rng(1)
+    for N_sites, noise, L in [(5000, 0.02, 2.2), (20000, 0.02, 2.2), (5000, 0.05, 2.2), (5000, 0.02, 2.6)]:
+        coords = graphene_coords(N_sites, noise=noise)
+        bonds = aab.Bonds(sites_of(coords), L/SAMPLING, incremental=True)
+        N_frames, N_recomputed, t_update, t_rebuild, diff = 10, 0, 0., 0., 0
+        for _ in range(N_frames):
+            frame = coords + rng.normal(0, noise/SAMPLING, coords.shape)
+            t = time.perf_counter()
+            N_recomputed += bonds.update(sites_of(frame))
+            t_update += time.perf_counter()-t
+            t = time.perf_counter()
+            rebuilt = aab.Bonds(sites_of(frame), L/SAMPLING)
+            t_rebuild += time.perf_counter()-t
+            diff += len(bond_set(bonds.lattice.pairs) ^ bond_set(rebuilt.lattice.pairs))
+        print(f"{len(coords):8d} {noise:9.2f} {L:6.1f} {N_frames:7d} {N_recomputed/N_frames:11.0f} "
+              f"{t_update/N_frames:11.4f} {t_rebuild/N_frames:12.4f} {diff:11d}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the time the plug-in adds to the start-up of Nion Swift.
+- Each measurement runs in a fresh interpreter (cold imports of Python modules, warm file system cache).
+- The baseline imports Nion Swift only, the second run imports Nion Swift and the plug-in.
+- Lists the slowest imports caused by the plug-in (python -X importtime) and whether the heavy dependencies,
+  which should only be imported on first use, were loaded.
+
+Usage (from the root folder of this package):
+    $ python3 ./benchmarks/bench_import.py [repeat]
+"""
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+BASELINE = "import nion.swift.Facade"
+PLUGIN = "import nionswift_plugin.atom_manipulator"
+
+# Imported on first use of the corresponding feature, not at start-up.
+DEFERRED = ['skimage', 'matplotlib', 'scipy.optimize', 'fourier_scale_calibration', 'double_gaussian_blur',
+            'adf_feedback', 'periodictable', 'nionswift_plugin.nionswift_structure_recognition']
+
+PROBE = """
+import sys, time
+t = time.perf_counter()
+{statements}
+t = time.perf_counter()-t
+print('TIME', t)
+print('LOADED', ' '.join(m for m in {deferred!r} if m in sys.modules))
+"""
+
+
+# Runs {statements} in a fresh interpreter. Returns the import time in seconds, the loaded deferred modules,
+# and the cumulative import times in microseconds of all modules, or None if the import failed.
+def run(statements):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    code = PROBE.format(statements=statements, deferred=DEFERRED)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+        return None
+
+    t = None
+    loaded = []
+    for line in result.stdout.splitlines():
+        if line.startswith('TIME'):
+            t = float(line.split()[1])
+        elif line.startswith('LOADED'):
+            loaded = line.split()[1:]
+
+    cumulative = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        cumulative[name.strip()] = int(cumulative_us)
+    return t, loaded, cumulative
+
+
+def best_of(statements, repeat):
+    results = []
+    for _ in range(repeat):
+        results.append(run(statements))
+        if results[-1] is None:
+            return None
+    return min(results, key=lambda x: x[0])
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    baseline = best_of(BASELINE, repeat)
+    plugin = best_of(BASELINE + "\n" + PLUGIN if baseline is not None else PLUGIN, repeat)
+    if plugin is None:
+        print("The plug-in could not be imported (are Nion Swift and its dependencies installed?).")
+        return
+
+    t_baseline = baseline[0] if baseline is not None else 0.
+    print(f"{'Nion Swift [s]':>15} {'with plug-in [s]':>17} {'added [s]':>10}")
+    print(f"{t_baseline:15.3f} {plugin[0]:17.3f} {plugin[0]-t_baseline:10.3f}")
+
+    # Modules imported because of the plug-in, by cumulative import time.
+    added = {k: v for k, v in plugin[2].items() if baseline is None or k not in baseline[2]}
+    print("\nSlowest imports caused by the plug-in (cumulative, including nested imports):")
+    for name in sorted(added, key=lambda k: -added[k])[:15]:
+        print(f"  {added[name]/1e6:8.3f} s  {name}")
+
+    print("\nDeferred dependencies loaded at start-up:", ', '.join(plugin[1]) if plugin[1] else 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the frame ingestion in lib_utils.init_pdi (raw data and metadata, normalization to RGB) on synthetic
+frames, without Nion Swift.
+- Before: deep copy of the source frame (data and metadata), normalization with temporaries and np.tile.
+- After: the raw data shared read-only, a shallow copy of the metadata, normalization into the preallocated base of
+  the overlay compositor and composition of the displayed buffer.
+- Reports the time and the memory allocated per frame (tracemalloc, peak and still allocated after the frame) in
+  steady state, i.e. after a first frame of the same shape.
+
+Usage (from the root folder of this package):
+    $ python3 ./benchmarks/bench_init_pdi.py
+"""
+
+import os
+import sys
+import copy
+import time
+import tracemalloc
+
+import numpy as np
+
+# Import the back-end module without loading the Nion Swift plug-in itself.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nionswift_plugin', 'atom_manipulator'))
+import lib_overlay
+
+ROOT_KEY = "AtomManipulator"
+
+
+# Stand-in for the source frame (data and metadata of a DataAndMetadata object).
+class Frame(object):
+    def __init__(self, data, metadata):
+        self.data = data
+        self.metadata = metadata
+
+
+# Scan and hardware metadata of a typical frame.
+def scan_metadata(seed=0):
+    rng = np.random.default_rng(seed)
+    instrument = {f"parameter_{i:d}": float(x) for i, x in enumerate(rng.random(300))}
+    return {'hardware_source': {'hardware_source_id': 'superscan', 'channel_name': 'HAADF',
+                                'fov_nm': 8., 'rotation': 0., 'pixel_time_us': 2.},
+            'scan': {'center_x_nm': 0., 'center_y_nm': 0., 'scan_id': '0' * 36, 'frame_index': 0},
+            'instrument': instrument}
+
+
+def ingest_before(frame, metadata_to_append, state):
+    xdata = copy.deepcopy(frame)
+    xdata.metadata[ROOT_KEY] = metadata_to_append
+    data = np.array(xdata.data)
+    rgb_data = np.tile(((data - data.min()) / (data.max() - data.min()) * 255).astype(np.uint8)[..., None],
+                       (1, 1, 3))
+    state['original_data'] = data
+    state['rgb_data'] = rgb_data
+    return rgb_data
+
+
+def ingest_after(frame, metadata_to_append, state):
+    data = np.asarray(frame.data).view()
+    data.flags.writeable = False
+    metadata = dict(frame.metadata)
+    metadata[ROOT_KEY] = metadata_to_append
+    state['overlay'].set_frame(data)
+    state['original_data'] = data
+    return state['overlay'].compose()
+
+
+# Time and allocations (peak, kept after the frame) in bytes of one frame, after a warm-up frame.
+def measure(ingest, frame, state, repeat=5):
+    metadata_to_append = {'timestamp_1_frame_acquired': time.time()}
+    ingest(frame, metadata_to_append, state)
+    t_min = np.inf
+    for _ in range(repeat):
+        t = time.perf_counter()
+        ingest(frame, metadata_to_append, state)
+        t_min = min(t_min, time.perf_counter()-t)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    out = ingest(frame, metadata_to_append, state)
+    end, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t_min, peak-start, end-start, out
+
+
+def main():
+    print(f"{'frame':>11} {'dtype':>8} {'':>7} {'time [ms]':>10} {'peak [MB]':>10} {'kept [MB]':>10} {'equal':>6}")
+    rng = np.random.default_rng(0)
+    for size in [512, 1024, 2048, 4096]:
+        for dtype in [np.float32, np.uint16]:
+            data = (rng.random((size, size))*4000).astype(dtype)
+            frame = Frame(data, scan_metadata())
+            results = dict()
+            for name, ingest, state in [('before', ingest_before, dict()),
+                                        ('after', ingest_after, {'overlay': lib_overlay.OverlayCompositor()})]:
+                results[name] = measure(ingest, frame, state)
+            equal = np.array_equal(results['before'][3], results['after'][3])
+            for name, (t, peak, kept, _) in results.items():
+                print(f"{size:5d}x{size:<5d} {np.dtype(dtype).name:>8} {name:>7} {t*1e3:10.2f} "
+                      f"{peak/2**20:10.2f} {kept/2**20:10.2f} {str(equal) if name == 'after' else '':>6}")
+
+
+if __name__ == '__main__':
+    main()
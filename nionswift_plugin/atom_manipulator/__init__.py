@@ -1 +1,5 @@
-from nionswift_plugin.atom_manipulator import main
\ No newline at end of file
+import multiprocessing
+
+# Worker processes (spawned, see classes/path_pool.py) import the back-end modules only, not the Nion Swift plug-in.
+if multiprocessing.parent_process() is None:
+    from nionswift_plugin.atom_manipulator import main
\ No newline at end of file
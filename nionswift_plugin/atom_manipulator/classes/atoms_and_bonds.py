@@ -1,78 +1,75 @@
 import numpy as np
 import logging
 
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+# Number of sites above which candidate bonds are searched with a k-d tree instead of a dense distance matrix.
+KDTREE_SITE_THRESHOLD = 2000
+
 
 # Reworked class
 #
 # The original works are
 # Christoph Hofer et al, 2D Mater. 5 045029 (2018). https://doi.org/10.1088/2053-1583/aaded7
 # Christoph Hofer et al, Appl. Phys. Lett. 114, 053102 (2019). https://doi.org/10.1063/1.5063449  
-class Site:    
+class Site:
+    # Thin view on an entry of a "Lattice" once attached to it (see Lattice.attach).
+    # Before that, coordinates are kept by the site itself and it has no neighbors.
+
     def __init__(self, x, y, z = 0, site_id = None):
         self.id = site_id
-        self.coords = np.array([x, y])
-        self.neighbors = []
-        self.candidates = []
+        self.lattice = None
+        self.index = None # Row index in the lattice arrays.
+        self._coords = np.array([x, y])
         self.heavy = False
 
+    @staticmethod
+    def view(lattice, index, site_id = None):
+        # Creates a site without own coordinate storage.
+        site = Site.__new__(Site)
+        site.id = site_id
+        site.lattice = lattice
+        site.index = index
+        site._coords = None
+        site.heavy = False
+        return site
+
+    @property
+    def coords(self):
+        if self.lattice is None:
+            return self._coords
+        return self.lattice.coords[self.index]
+
+    @property
+    def neighbor_indices(self):
+        if self.lattice is None:
+            return np.empty(0, dtype=np.intp)
+        return self.lattice.neighbors(self.index)
+
+    @property
+    def neighbors(self):
+        if self.lattice is None:
+            return []
+        sites = self.lattice.sites
+        return [sites[i] for i in self.lattice.neighbors(self.index)]
+
     def relocate(self, x, y, z = 0):
-        self.coords = np.array([x, y, z])                 
+        if self.lattice is None:
+            self._coords = np.array([x, y])
+        else:
+            self.lattice.coords[self.index] = (x, y)
         
     def distance(self, site):
         x = self.coords - site.coords
         return np.sqrt(x[0]**2 + x[1]**2)
 
     def second_nearest_neighbors(self):
-        out = []
-
-        for n in self.neighbors:
-            for nn in n.neighbors:
-                if nn is not self:
-                    out.append(nn)
-        
-        return out
-    
-    def add_candidate(self, site2):
-        if self == site2:
-            # An atom itself must not be a candidate for its neighbor
-            return False
-        if not (self in site2.candidates or site2 in self.candidates):
-            self.candidates.append(site2)
-            site2.candidates.append(self)
-            return True
-        else:
-            return False
-    
-    def top_candidate(self):
-        if self.candidates == []:
-            return None
-        diff = self.coords - np.array(list(map(lambda x: x.coords, self.candidates)))
-        dist = np.sqrt(diff[:,0]**2 + diff[:,1]**2)
-        for idx in np.argsort(dist):
-            if self.eval_candidate(self.candidates[idx]):
-                return self.candidates[idx]
-        return None 
-
-    def add_neighbor(self, bond_candidate):
-        try:
-            self.candidates.remove(bond_candidate)
-            bond_candidate.candidates.remove(self)
-        except: pass
-        
-        if self not in bond_candidate.neighbors and bond_candidate not in self.neighbors:
-          # if self.eval_candidate(bond_candidate) and bond_candidate.eval_candidate(self): # done in top_candidate() else
-            self.neighbors.append(bond_candidate)
-            bond_candidate.neighbors.append(self)
-            return True 
-        else:
-            return False
-
-    def eval_candidate(self, bond_candidate): 
-        # No more than 4 neighbors
-        if len(self.neighbors)>=4:
-            return False
-        # No triangles
-        return not any( [bond_candidate in x.neighbors for x in self.neighbors] )
+        if self.lattice is None:
+            return []
+        sites = self.lattice.sites
+        return [sites[i] for i in self.lattice.second_nearest_neighbors(self.index)]
     
     def output_info(self):
         a_id = self.id
@@ -80,6 +77,215 @@ class Site:
         return "site ID " + str(a_id) + " with the coordinates " + str(a_coords)
 
 
+# Compact lattice graph
+#
+# Coordinates are stored in an (N, 2) array, bonds as adjacency in compressed sparse row (CSR) format:
+# the neighbors of site i are indices[indptr[i]:indptr[i+1]], in the order in which the bonds were set.
+class Lattice:
+    # sites ... list of class members of "Site", sites[i].index == i
+    # coords ... (N, 2) numpy.ndarray
+    # indptr, indices ... CSR adjacency (numpy.ndarray of int)
+    # pairs ... (M, 2) numpy.ndarray of bonded site indices
+    # longest_bond ... length of the longest bond (in pixels), 0 without bonds
+    # ids ... persistent site IDs (numpy.ndarray of int) if the lattice was tracked (see SiteTracker), else None
+
+    def __init__(self, sites):
+        self.sites = list(sites)
+        self.coords = np.array([x.coords for x in self.sites], dtype=float).reshape(-1, 2)
+        self.ids = None
+        self.set_bonds(np.empty((0, 2), dtype=np.intp))
+        for i, site in enumerate(self.sites):
+            self.attach(site, i)
+
+    @staticmethod
+    def from_coords(coords, site_ids = None):
+        # Creates a lattice and its sites directly from an (N, 2) array of coordinates.
+        lattice = Lattice.__new__(Lattice)
+        lattice.coords = np.array(coords, dtype=float).reshape(-1, 2)
+        N = len(lattice.coords)
+        if site_ids is None:
+            site_ids = range(N)
+        lattice.sites = [Site.view(lattice, i, site_id) for i, site_id in zip(range(N), site_ids)]
+        lattice.ids = None
+        lattice.set_bonds(np.empty((0, 2), dtype=np.intp))
+        return lattice
+
+    @staticmethod
+    def of(sites):
+        # Returns the lattice which all the sites are attached to (in this order), or a new lattice.
+        lattice = sites[0].lattice if len(sites) > 0 else None
+        if lattice is not None and len(lattice.sites) == len(sites) and \
+                all(a is b for a, b in zip(lattice.sites, sites)):
+            return lattice
+        return Lattice(sites)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def attach(self, site, index):
+        site.lattice = self
+        site.index = index
+        site._coords = None
+
+    def set_bonds(self, pairs):
+        # pairs ... (M, 2) array of site indices in the order in which the bonds were set.
+        N = len(self.coords)
+        self.pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+        self.longest_bond = 0.
+        if len(self.pairs) > 0:
+            self.longest_bond = float(np.linalg.norm(
+                self.coords[self.pairs[:, 0]] - self.coords[self.pairs[:, 1]], axis=1).max())
+        src = self.pairs.ravel()
+        dst = self.pairs[:, ::-1].ravel()
+        order = np.argsort(src, kind='stable')
+        self.indices = dst[order]
+        self.indptr = np.zeros(N+1, dtype=np.intp)
+        np.cumsum(np.bincount(src, minlength=N), out=self.indptr[1:])
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def neighbors_of(self, idx):
+        # Concatenated neighbors of all sites in idx (with repetitions).
+        idx = np.asarray(idx, dtype=np.intp).ravel()
+        starts = self.indptr[idx]
+        counts = self.indptr[idx+1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.indices[offsets]
+
+    def second_nearest_neighbors(self, i):
+        out = self.neighbors_of(self.neighbors(i))
+        return out[out != i]
+
+    def neighborhood(self, idx, depth):
+        # Boolean mask of all sites that are at most depth bonds away from any site in idx.
+        mask = np.zeros(len(self.coords), dtype=bool)
+        frontier = np.unique(np.asarray(idx, dtype=np.intp).ravel())
+        mask[frontier] = True
+        for _ in range(depth):
+            frontier = np.unique(self.neighbors_of(frontier))
+            frontier = frontier[~mask[frontier]]
+            mask[frontier] = True
+        return mask
+
+    def neighborhood_indices(self, idx, depth):
+        # Sorted indices of all sites that are at most depth bonds away from any site in idx.
+        out = frontier = np.unique(np.asarray(idx, dtype=np.intp).ravel())
+        for _ in range(depth):
+            frontier = np.setdiff1d(self.neighbors_of(frontier), out)
+            out = np.union1d(out, frontier)
+        return out
+
+
+# Greedy one-to-one matching of the sites of two consecutive frames.
+# Each site is matched to the nearest previous site within max_displacement; if several sites claim the same
+# previous site, the closest one wins. Returns the index of the matched previous site for each site, or -1.
+def match_sites(previous_coords, coords, max_displacement):
+    previous_coords = np.asarray(previous_coords, dtype=float).reshape(-1, 2)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    match = np.full(len(coords), -1, dtype=np.intp)
+    if len(previous_coords) == 0 or len(coords) == 0:
+        return match
+
+    distance, nearest = cKDTree(previous_coords).query(coords, distance_upper_bound=max_displacement)
+    valid = np.isfinite(distance)
+    claims = np.bincount(nearest[valid], minlength=len(previous_coords))
+
+    # Unique claims.
+    unique = valid & (claims[np.minimum(nearest, len(previous_coords)-1)] == 1)
+    match[unique] = nearest[unique]
+
+    # Conflicting claims, closest first.
+    conflicting = np.nonzero(valid & ~unique)[0]
+    taken = set()
+    for i in conflicting[np.argsort(distance[conflicting], kind='stable')].tolist():
+        if nearest[i] not in taken:
+            taken.add(nearest[i])
+            match[i] = nearest[i]
+
+    return match
+
+
+# Matching of the sites of two tracked lattices by their persistent IDs.
+# Returns the index of the previous site with the same ID for each site, or -1.
+def match_ids(previous_ids, ids):
+    previous_ids = np.asarray(previous_ids)
+    ids = np.asarray(ids)
+    match = np.full(len(ids), -1, dtype=np.intp)
+    if len(previous_ids) == 0 or len(ids) == 0:
+        return match
+    order = np.argsort(previous_ids, kind='stable')
+    pos = np.minimum(np.searchsorted(previous_ids, ids, sorter=order), len(previous_ids)-1)
+    found = previous_ids[order[pos]] == ids
+    match[found] = order[pos[found]]
+    return match
+
+
+# Persistent site identities across frames
+#
+# The sites of each frame are matched to the sites of the previously tracked frame (see match_sites). Matched sites
+# inherit the ID of their predecessor, all other sites get new IDs. Objects holding a site of an earlier frame
+# (target sites, foreign atoms) are reattached to the current site with the same ID by a dictionary lookup.
+class SiteTracker:
+    # max_displacement ... maximum displacement of a site between frames (in pixels)
+    # lattice ... last tracked class member of "Lattice"
+    # match ... index of the matched site of the previously tracked lattice for each site of the last one, or -1
+    # sites_by_id ... dict of the sites of the last tracked lattice
+
+    def __init__(self, max_displacement):
+        self.max_displacement = max_displacement
+        self.reset()
+
+    def reset(self):
+        # Forgets all identities, e.g. if the scan parameters changed.
+        self.lattice = None
+        self.match = None
+        self.sites_by_id = {}
+        self.next_id = 0
+        self._tree = None
+
+    def track(self, lattice):
+        # Assigns persistent IDs to the sites of the lattice. Returns the number of sites with a new ID.
+        N = len(lattice)
+        if self.lattice is None:
+            match = np.full(N, -1, dtype=np.intp)
+        else:
+            match = match_sites(self.lattice.coords, lattice.coords, self.max_displacement)
+        ids = np.empty(N, dtype=np.int64)
+        matched = match >= 0
+        if self.lattice is not None:
+            ids[matched] = self.lattice.ids[match[matched]]
+        N_new = N - np.count_nonzero(matched)
+        ids[~matched] = np.arange(self.next_id, self.next_id + N_new)
+        self.next_id += N_new
+
+        lattice.ids = ids
+        for site, site_id in zip(lattice.sites, ids.tolist()):
+            site.id = site_id
+        self.sites_by_id = dict(zip(ids.tolist(), lattice.sites))
+        self.lattice = lattice
+        self.match = match
+        self._tree = None
+        return N_new
+
+    def lookup(self, site):
+        # Returns the site of the last tracked lattice with the same ID as the given site, or None.
+        if site is None or site.id is None:
+            return None
+        return self.sites_by_id.get(site.id)
+
+    def nearest(self, position):
+        # Returns the site of the last tracked lattice nearest to the position (in pixels), or None.
+        if self.lattice is None or len(self.lattice) == 0:
+            return None
+        if self._tree is None:
+            self._tree = cKDTree(self.lattice.coords)
+        return self.lattice.sites[self._tree.query(position)[1]]
+
+
 # Original work
 class Atom(object):
     
@@ -134,45 +340,307 @@ class Bond:
 # Christoph Hofer et al, 2D Mater. 5 045029 (2018). https://doi.org/10.1088/2053-1583/aaded7
 # Christoph Hofer et al, Appl. Phys. Lett. 114, 053102 (2019). https://doi.org/10.1063/1.5063449  
 class Bonds:
-    # sites ... list of class members of "Atom"
-    # members ... list of class members of "Bond"
-    
-    def __init__(self, sites, max_bond_length, build_bonds_on_init_flag = True):
-        self.members = []
+    # sites ... list of class members of "Site"
+    # lattice ... class member of "Lattice" holding the coordinates and bonds of all sites
+    # members ... list of class members of "Bond" (created on access)
+    # neighbor_search ... 'auto', 'kdtree' or 'dense'
+    # selection ... 'single_pass' (default) or 'sweeps' (reference, same bond set, see select_bonds)
+    # incremental ... if True, the data for incremental updates (see update) is kept
+    #
+    # For incremental updates:
+    # tolerance ... maximum displacement of a site w.r.t. its reference position to keep its near pairs (in pixels)
+    # reference_coords ... positions of the sites when their near pairs were last searched
+    # near_pairs ... all pairs of sites within the max. bond length plus twice the tolerance at the reference
+    #                positions (row-major order, see candidate_pairs), i.e. all pairs that can be bond candidates
+
+    def __init__(self, sites, max_bond_length, build_bonds_on_init_flag = True, neighbor_search = 'auto',
+                 selection = 'single_pass', incremental = False):
         self.max_bond_length = max_bond_length # in pixels
-        
+        self.neighbor_search = neighbor_search
+        self.selection = selection
+        self.incremental = incremental
+        self.lattice = Lattice.of(sites)
+        self.tolerance = 0.1*max_bond_length
+        self.reference_coords = None
+        self.near_pairs = None
+
         if build_bonds_on_init_flag:
-            self.members = Bonds.build_bonds(sites, self.max_bond_length)
-        
-    def build_bonds(sites, max_bond_length):
-        N_candidates = 0
-        # Get all coords and delete old candidates and neighbors
-        def func(x):
-            x.candidates = []
-            x.neighbors = []
-            return x.coords
-        all_coords = np.array(list(map(func, sites)))
-        distances = np.linalg.norm(all_coords-all_coords[:, np.newaxis, :], axis=2)
-        ind_0, ind_1 = np.where( (distances<=max_bond_length) )
-        for k in range(len(ind_0)):
-            if sites[ind_0[k]].add_candidate(sites[ind_1[k]]):
-                N_candidates += 1
-        print('Total number of candidate bonds: %d' % N_candidates)
+            self.rebuild()
+
+    @property
+    def members(self):
+        sites = self.lattice.sites
+        return [Bond(sites[i], sites[j]) for i, j in self.lattice.pairs]
+
+    def rebuild(self):
+        # Builds all bonds of the lattice from scratch. Returns the number of sites.
+        lattice = self.lattice
+        if not self.incremental:
+            Bonds.build_bonds(lattice, self.max_bond_length, neighbor_search=self.neighbor_search,
+                              selection=self.selection)
+            return len(lattice)
+
+        self.reference_coords = lattice.coords.copy()
+        self.near_pairs = Bonds.candidate_pairs(lattice.coords, self.max_bond_length + 2*self.tolerance,
+                                                neighbor_search=self.neighbor_search)
+        self.select_near_pairs()
+        return len(lattice)
+
+    def update(self, sites, match=None, max_displacement=None):
+        # Incremental update of the bonds for the sites of a consecutive frame (needs incremental=True).
+        # Sites are matched to the sites of the previous frame (see match_sites). A site is unchanged as long as
+        # it stays within the tolerance of its reference position. The near pairs between unchanged sites are
+        # kept, they are searched again only around sites that appeared, vanished or moved further.
+        # The bonds are then selected among all candidates, as by a rebuild: the selection of a bond can depend on
+        # sites far away (see select_bonds), so selecting only near the changed sites would not give the same bonds.
+        # match ... index of the matched previous site for each site or -1, by persistent IDs or matched here if None
+        # max_displacement ... maximum displacement of a site between frames, default: 1/2 max. bond length
+        # Returns the number of sites whose near pairs were searched again.
+        if max_displacement is None:
+            max_displacement = 0.5*self.max_bond_length
+        r = self.max_bond_length + 2*self.tolerance
+
+        previous = self.lattice
+        self.lattice = Lattice.of(sites)
+        lattice = self.lattice
+        N = len(lattice)
+        if not self.incremental or self.reference_coords is None or len(previous) == 0 or N == 0:
+            return self.rebuild()
+
+        if match is None and previous.ids is not None and lattice.ids is not None:
+            match = match_ids(previous.ids, lattice.ids) # Persistent IDs (see SiteTracker).
+        elif match is None:
+            match = match_sites(previous.coords, lattice.coords, max_displacement)
+        unchanged = match >= 0
+        unchanged[unchanged] = np.linalg.norm(
+            lattice.coords[unchanged] - self.reference_coords[match[unchanged]], axis=1) <= self.tolerance
+        recompute = ~unchanged
+        N_recompute = np.count_nonzero(recompute)
+        if N_recompute > N/2:
+            return self.rebuild()
+
+        to_new = np.full(len(previous), -1, dtype=np.intp) # Previous to new site index of unchanged sites.
+        to_new[match[unchanged]] = np.nonzero(unchanged)[0]
+        reference_coords = lattice.coords.copy()
+        reference_coords[unchanged] = self.reference_coords[match[unchanged]]
+
+        # Near pairs between unchanged sites.
+        kept = to_new[self.near_pairs]
+        kept = kept[(kept >= 0).all(axis=1)]
+
+        # Near pairs with at least one recomputed site, searched among the sites within reach of them.
+        region = recompute.copy()
+        if N_recompute > 0:
+            idx = cKDTree(reference_coords).query_ball_point(reference_coords[recompute], r, return_sorted=False)
+            region[np.concatenate([np.asarray(x, dtype=np.intp) for x in idx])] = True
+        region_idx = np.nonzero(region)[0]
+        pairs = region_idx[Bonds.candidate_pairs(reference_coords[region_idx], r,
+                                                 neighbor_search=self.neighbor_search)]
+        pairs = pairs[recompute[pairs[:, 0]] | recompute[pairs[:, 1]]]
+
+        near_pairs = np.sort(np.concatenate((kept, pairs)), axis=1)
+        self.near_pairs = near_pairs[np.lexsort((near_pairs[:, 1], near_pairs[:, 0]))]
+        self.reference_coords = reference_coords
+        self.select_near_pairs()
+        return N_recompute
+
+    def select_near_pairs(self):
+        # Sets the bonds among the near pairs that are bond candidates at the current positions.
+        lattice = self.lattice
+        pairs = self.near_pairs[Bonds.pair_lengths(lattice.coords, self.near_pairs) <= self.max_bond_length]
+        logging.debug("Total number of candidate bonds: %d" % len(pairs))
+        lattice.set_bonds(Bonds.select(lattice.coords, pairs, self.selection))
+        logging.info("Number of bonds set: %d" % len(lattice.pairs))
+
+    @staticmethod
+    def pair_lengths(coords, pairs):
+        diff = coords[pairs[:, 0]] - coords[pairs[:, 1]]
+        return np.sqrt(diff[:, 0]**2 + diff[:, 1]**2)
+
+    @staticmethod
+    def candidate_pairs(all_coords, max_bond_length, neighbor_search='auto'):
+        # Returns all index pairs (i, j) with i < j and a distance of at most max_bond_length.
+        # Pairs are sorted in row-major order, i.e. in the order of a traversal of the dense distance matrix.
+        all_coords = np.asarray(all_coords, dtype=float).reshape(-1, 2)
+
+        if neighbor_search == 'auto':
+            neighbor_search = 'kdtree' if len(all_coords) > KDTREE_SITE_THRESHOLD else 'dense'
+
+        if neighbor_search == 'kdtree': # O(N log N) time, O(N) memory.
+            pairs = cKDTree(all_coords).query_pairs(max_bond_length, output_type='ndarray')
+            pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        elif neighbor_search == 'dense': # O(N^2) time and memory.
+            distances = np.linalg.norm(all_coords-all_coords[:, np.newaxis, :], axis=2)
+            ind_0, ind_1 = np.where( np.triu(distances<=max_bond_length, k=1) )
+            pairs = np.stack((ind_0, ind_1), axis=1)
+        else:
+            raise ValueError(f"Unknown neighbor search mode '{neighbor_search}'.")
+
+        return pairs.reshape(-1, 2)
+
+    @staticmethod
+    def build_bonds(lattice, max_bond_length, neighbor_search='auto', selection='single_pass'):
+        pairs = Bonds.candidate_pairs(lattice.coords, max_bond_length, neighbor_search=neighbor_search)
+        logging.debug("Total number of candidate bonds: %d" % len(pairs))
+        lattice.set_bonds(Bonds.select(lattice.coords, pairs, selection))
+        logging.info("Number of bonds set: %d" % len(lattice.pairs))
+        return lattice
+
+    @staticmethod
+    def select(coords, pairs, selection='single_pass'):
+        # Returns the bonds among the candidate pairs (row-major order, see candidate_pairs).
+        if selection == 'single_pass':
+            return Bonds.select_bonds(coords, pairs)
+        elif selection == 'sweeps':
+            return Bonds.select_bonds_sweeps(coords, pairs)
+        raise ValueError(f"Unknown bond selection mode '{selection}'.")
+
+    @staticmethod
+    def select_bonds(coords, pairs):
+        # Same bonds as the sweeps (select_bonds_sweeps), with the candidates of each site sorted once by length.
+        # Rules: no more than 4 neighbors of the proposing site, no triangles.
+        #
+        # A candidate bond whose sites both have at most 4 candidates and which is not part of a triangle of
+        # candidates (uncontested) is set by the sweeps in any case. Whether a contested bond is set depends on the
+        # bonds set before at its sites: the shorter candidates of each site (proposed first), all candidates of
+        # a site with more than 4 of them (its number of neighbors), and the other bonds of its triangles. These
+        # dependencies are followed from the contested bonds on; the bonds reached are replayed in the order of
+        # the sweeps, all others are set at once.
+        N = len(coords)
+        M = len(pairs)
+        if M == 0:
+            return pairs.reshape(-1, 2)
+
+        # Candidates of each site, sorted by distance (CSR format), as in the sweeps.
+        src = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        dst = np.concatenate((pairs[:, 1], pairs[:, 0]))
+        length = Bonds.pair_lengths(coords, pairs)
+        order = np.lexsort((np.concatenate((length, length)), src))
+        cand_indptr = np.zeros(N+1, dtype=np.intp)
+        np.cumsum(np.bincount(src, minlength=N), out=cand_indptr[1:])
+        N_candidates = np.diff(cand_indptr)
+        rank = np.empty(2*M, dtype=np.intp) # Position in the candidates of the site, for both sites of a bond.
+        rank[order] = np.arange(2*M) - cand_indptr[src[order]]
+        rank = rank.reshape(2, M)
+
+        adjacency = sparse.csr_matrix((np.ones(2*M, dtype=np.int32), (src, dst)), shape=(N, N))
+        in_triangle = np.asarray((adjacency @ adjacency)[pairs[:, 0], pairs[:, 1]]).ravel() > 0
+        crowded = N_candidates > 4
+        contested = in_triangle | crowded[pairs[:, 0]] | crowded[pairs[:, 1]]
+        if not contested.any():
+            return pairs
+
+        # The other bonds of the triangles of each bond, as pairs of bond indices.
+        tri = np.nonzero(in_triangle)[0]
+        bond_index = sparse.csr_matrix((np.tile(np.arange(1, M+1), 2), (src, dst)), shape=(N, N))
+        common = adjacency[pairs[tri, 0]].multiply(adjacency[pairs[tri, 1]]).tocoo()
+        k = tri[common.row]
+        tri_bond = np.tile(k, 2)
+        tri_other = np.concatenate((np.asarray(bond_index[pairs[k, 0], common.col]).ravel(),
+                                    np.asarray(bond_index[pairs[k, 1], common.col]).ravel())) - 1
+
+        # Bonds to be replayed. Those of a site are the leading part of its candidates (reach).
+        replay = contested
+        while True:
+            replay[tri_other[replay[tri_bond]]] = True
+            reach = np.zeros(N, dtype=np.intp)
+            np.maximum.at(reach, pairs[replay, 0], rank[0, replay] + 1)
+            np.maximum.at(reach, pairs[replay, 1], rank[1, replay] + 1)
+            reach[crowded & (reach > 0)] = N_candidates[crowded & (reach > 0)]
+            reached = (rank[0] < reach[pairs[:, 0]]) | (rank[1] < reach[pairs[:, 1]])
+            if not (reached & ~replay).any():
+                break
+            replay |= reached
+
+        # Replay of the sweeps. A site that finds no candidate does not find one in a later sweep (bonds are only
+        # added), and a candidate skipped once is skipped for good: each site resumes where it stopped.
+        entries = order[np.tile(replay, 2)[order]]
+        cand_indptr = np.zeros(N+1, dtype=np.intp)
+        np.cumsum(np.bincount(src[entries], minlength=N), out=cand_indptr[1:])
+        cursor = cand_indptr[:-1].tolist()
+        end = cand_indptr[1:].tolist()
+        cand_site = dst[entries].tolist()
+        cand_pair = (entries % M).tolist()
+        pair_used = bytearray(M)
+        neighbor_sets = [set() for _ in range(N)]
+        bonds = []
+        active = np.nonzero(cand_indptr[1:] > cand_indptr[:-1])[0].tolist()
+
+        it = 0
+        while len(active) > 0 and it < 50:
+            it += 1
+            proposed = []
+            for i in active:
+                neighbors_i = neighbor_sets[i]
+                # No more than 4 neighbors
+                if len(neighbors_i) >= 4:
+                    continue
+                # Top candidate
+                k = cursor[i]
+                while k < end[i]:
+                    j = cand_site[k]
+                    k += 1
+                    # No triangles
+                    if pair_used[cand_pair[k-1]] or not neighbors_i.isdisjoint(neighbor_sets[j]):
+                        continue
+                    pair_used[cand_pair[k-1]] = True
+                    neighbors_i.add(j)
+                    neighbor_sets[j].add(i)
+                    bonds.append((i, j))
+                    proposed.append(i)
+                    break
+                cursor[i] = k
+            active = proposed
+
+        return np.concatenate((pairs[~replay], np.array(bonds, dtype=np.intp).reshape(-1, 2)))
+
+    @staticmethod
+    def select_bonds_sweeps(coords, pairs):
+        # Former algorithm: every site repeatedly picks its nearest candidate that passes the rules
+        # (evaluated for this site only), until no bond is added any more.
+        N = len(coords)
+        N_candidates = len(pairs)
+
+        # Candidates of each site, sorted by distance (CSR format).
+        src = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        dst = np.concatenate((pairs[:, 1], pairs[:, 0]))
+        diff = coords[src] - coords[dst]
+        order = np.lexsort((np.sqrt(diff[:, 0]**2 + diff[:, 1]**2), src))
+        cand_indptr = np.zeros(N+1, dtype=np.intp)
+        np.cumsum(np.bincount(src, minlength=N), out=cand_indptr[1:])
+        cand_indptr = cand_indptr.tolist()
+        cand_site = dst[order].tolist()
+        cand_pair = np.tile(np.arange(N_candidates), 2)[order].tolist()
         
         # Algorithm could be made faster
+        pair_used = [False] * N_candidates
+        neighbors = [[] for _ in range(N)]
+        neighbor_sets = [set() for _ in range(N)]
         bonds = []
         num_bonds = -1
-        sites_copy = sites
         
         it = 0
         while len(bonds) > num_bonds and it < 50:
             it+=1
             num_bonds = len(bonds)
-            #sites_check_omit = set()
-            for i in range(len(sites_copy)):
-                atc = sites_copy[i].top_candidate()
-                if atc and sites_copy[i].add_neighbor(atc): #NEW functionality instead of just "if atc"
-                    bonds.append(Bond(sites_copy[i], atc))   
-                        
-        logging.info("Number of bonds set: %d" % len(bonds))
-        return bonds
+            for i in range(N):
+                # No more than 4 neighbors
+                if len(neighbors[i]) >= 4:
+                    continue
+                # Top candidate
+                for k in range(cand_indptr[i], cand_indptr[i+1]):
+                    j = cand_site[k]
+                    if pair_used[cand_pair[k]]:
+                        continue
+                    # No triangles
+                    if any(j in neighbor_sets[x] for x in neighbors[i]):
+                        continue
+                    pair_used[cand_pair[k]] = True
+                    neighbors[i].append(j)
+                    neighbors[j].append(i)
+                    neighbor_sets[i].add(j)
+                    neighbor_sets[j].add(i)
+                    bonds.append((i, j))
+                    break
+
+        return np.array(bonds, dtype=np.intp).reshape(-1, 2)
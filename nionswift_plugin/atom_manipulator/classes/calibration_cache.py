@@ -0,0 +1,92 @@
+"""
+Cache of scale calibrations (sampling in Angstroem/px).
+- Keyed on the field of view, the frame size and the detector channel.
+- A cached sampling is re-validated every N frames. If the re-validated sampling deviates by more than the tolerance
+  (drift), the entry is replaced and re-validated again on the next frame.
+- Persisted as JSON file between sessions.
+"""
+
+import os
+import json
+import logging
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.nionswift_atom_manipulator', 'calibration_cache.json')
+
+
+class CalibrationCache(object):
+    # revalidate_every ... number of frames after which a cached sampling is determined again, 0: never
+    # drift_tolerance ... relative deviation of a re-validated sampling considered as drift
+    # path ... JSON file, None: not persisted
+
+    def __init__(self, revalidate_every=50, drift_tolerance=0.02, path=DEFAULT_PATH):
+        self.revalidate_every = revalidate_every
+        self.drift_tolerance = drift_tolerance
+        self.path = path
+        self.entries = dict() # key -> sampling
+        self.frames = dict()  # key -> frames since last validation
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def key(fov_nm, shape, channel):
+        # Returns None if the field of view is unknown.
+        if fov_nm is None:
+            return None
+        return f"{float(fov_nm):.6g}nm|{'x'.join(str(int(s)) for s in shape)}|{channel}"
+
+    def get(self, key):
+        # Returns the cached sampling or None if not cached or due for re-validation.
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return None
+        self.frames[key] = self.frames.get(key, 0) + 1
+        if self.revalidate_every and self.frames[key] >= self.revalidate_every:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.entries[key]
+
+    def put(self, key, sampling):
+        # Stores a (re-)validated sampling. Returns True if it deviates from the cached one (drift).
+        if key is None or sampling is None:
+            return False
+        previous = self.entries.get(key)
+        drift = previous is not None and abs(sampling-previous) > self.drift_tolerance*previous
+        self.entries[key] = float(sampling)
+        # After drift, re-validate on the next frame.
+        self.frames[key] = self.revalidate_every-1 if drift and self.revalidate_every else 0
+        if previous is None or drift:
+            self.save()
+        return drift
+
+    def invalidate(self, key=None):
+        # Forces re-validation of one or all entries.
+        keys = list(self.entries) if key is None else [key]
+        for k in keys:
+            self.frames[k] = self.revalidate_every
+
+    def clear(self):
+        self.entries = dict()
+        self.frames = dict()
+        self.save()
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = {k: float(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning(f"Calibration cache not loaded from {self.path}: {e}")
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+        except OSError as e:
+            logging.warning(f"Calibration cache not saved to {self.path}: {e}")
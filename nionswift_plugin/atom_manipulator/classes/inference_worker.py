@@ -0,0 +1,137 @@
+"""
+Neural-network inference in a persistent worker process.
+- The model is loaded once when the worker starts and stays loaded.
+- Frames are passed to the worker in shared memory, the per-point arrays of the output ('points', 'labels', ...)
+  are returned in shared memory. Both blocks are owned by the parent and grown on demand.
+- The worker is callable like the model: worker(image, sampling).
+- This module and the worker entry points (_init_worker, _infer) import no Nion Swift modules; the plug-in itself is
+  not imported in the worker process (see the package __init__).
+"""
+
+import numpy as np
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+# Worker state.
+_model = None
+_blocks = dict() # role ('frame' or 'out') -> attached SharedMemory
+
+
+def _init_worker(preset):
+    global _model, _blocks
+    from nionswift_plugin.nionswift_structure_recognition.model import load_preset_model
+    _model = load_preset_model(preset)
+    _blocks = dict()
+
+
+def _attach(role, name):
+    shm = _blocks.get(role)
+    if shm is None or shm.name != name:
+        if shm is not None:
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name) # Owned and unlinked by the parent.
+        _blocks[role] = shm
+    return shm
+
+
+def _ready():
+    return _model is not None
+
+
+# Runs the model in the worker.
+# frame ... (name, shape, dtype) of the frame in shared memory
+# out ... (name, size) of the output block
+# Returns a list of (key, dtype, shape, offset) of the per-point arrays in the output block,
+# or the arrays themselves ({key: array}) if they do not fit.
+def _infer(frame, out, sampling):
+    name, shape, dtype = frame
+    image = np.ndarray(shape, dtype=dtype, buffer=_attach('frame', name).buf)
+    output = _model(image, sampling)
+    del image
+    if output is None:
+        return None
+
+    points = np.asarray(output['points'])
+    arrays = {'points': points}
+    for key, value in output.items():
+        if key != 'points' and isinstance(value, np.ndarray) and value.ndim > 0 and len(value) == len(points):
+            arrays[key] = value
+
+    name, size = out
+    if sum(x.nbytes for x in arrays.values()) > size:
+        return arrays
+    buf = _attach('out', name).buf
+    layout = []
+    offset = 0
+    for key, value in arrays.items():
+        np.ndarray(value.shape, dtype=value.dtype, buffer=buf, offset=offset)[...] = value
+        layout.append((key, value.dtype.str, value.shape, offset))
+        offset += value.nbytes
+    return layout
+
+
+class InferenceWorker(object):
+    # preset ... name of the preset model, loaded in the worker
+
+    def __init__(self, preset='graphene'):
+        self.executor = ProcessPoolExecutor(max_workers=1,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(preset,))
+        self.lock = threading.Lock()
+        self.closed = False
+        self.frame_shm = None
+        self.out_shm = None
+        self.out_size = 1 << 20
+        self.warmup = self.executor.submit(_ready) # Starts the worker and loads the model in the background.
+
+    @property
+    def ready(self):
+        return self.warmup.done() and self.warmup.exception() is None
+
+    def __call__(self, image, sampling):
+        image = np.asarray(image)
+        with self.lock:
+            if self.closed: # No new shared memory after close.
+                raise RuntimeError("The inference worker is closed.")
+            # Frame to shared memory (the only copy of the frame).
+            if self.frame_shm is None or self.frame_shm.size < image.nbytes:
+                self.frame_shm = self._renew(self.frame_shm, image.nbytes)
+            np.ndarray(image.shape, dtype=image.dtype, buffer=self.frame_shm.buf)[...] = image
+            if self.out_shm is None:
+                self.out_shm = self._renew(None, self.out_size)
+
+            layout = self.executor.submit(_infer, (self.frame_shm.name, image.shape, image.dtype.str),
+                                          (self.out_shm.name, self.out_shm.size), sampling).result()
+            if layout is None:
+                return None
+            if isinstance(layout, dict): # Did not fit, grow for the next frame.
+                self.out_size = 2*sum(x.nbytes for x in layout.values())
+                self.out_shm = self._renew(self.out_shm, self.out_size)
+                return layout
+            # Copied out, the output of a frame outlives the block.
+            return {key: np.ndarray(shape, dtype=dtype, buffer=self.out_shm.buf, offset=offset).copy()
+                    for key, dtype, shape, offset in layout}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock: # After a running call.
+            self.closed = True
+            self._renew(self.frame_shm, 0)
+            self._renew(self.out_shm, 0)
+            self.frame_shm = None
+            self.out_shm = None
+
+    def _renew(self, shm, size):
+        # Releases {shm} and returns a new block of {size} bytes (None if size is 0).
+        if shm is not None:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        if size == 0:
+            return None
+        return shared_memory.SharedMemory(create=True, size=size)
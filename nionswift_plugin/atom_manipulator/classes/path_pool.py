@@ -0,0 +1,165 @@
+"""
+Evaluation of independent candidate paths on a pool of worker processes.
+- Used for the direct paths of all atoms in Paths.determine_paths_no_collision, which are evaluated in one batch
+  (see Paths.prefetch_direct_paths). The searches around blockers (unblocked paths, subpaths of reassigned atoms)
+  depend on the atoms moved before and are done sequentially in the calling process.
+- The pool is persistent. The lattice of the current frame is published once in shared memory (coordinates and
+  bonds in CSR format) and rebuilt by each worker on its first task for that lattice.
+- Tasks and results are site indices only.
+- Once the pool is closed (or if a worker fails), paths are determined in the calling process.
+"""
+
+import numpy as np
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from multiprocessing import shared_memory
+
+from . import atoms_and_bonds as aab
+from . import paths
+
+
+# Worker state.
+_descriptor = None
+_shm = None
+_lattice = None
+
+
+def _init_worker():
+    global _descriptor, _shm, _lattice
+    _descriptor = None
+    _shm = None
+    _lattice = None
+
+
+# Rebuilds the published lattice in a worker (once per lattice).
+def _attach(descriptor):
+    global _descriptor, _shm, _lattice
+    if descriptor == _descriptor:
+        return _lattice
+
+    if _shm is not None:
+        _shm.close()
+    name, N, M = descriptor
+    _shm = shared_memory.SharedMemory(name=name) # Owned and unlinked by the parent.
+    coords, indptr, indices = _views(_shm.buf, N, M)
+
+    lattice = aab.Lattice.from_coords(coords)
+    src = np.repeat(np.arange(N), np.diff(indptr))
+    is_pair = src < indices
+    lattice.set_bonds(np.stack((src[is_pair], indices[is_pair]), axis=1))
+    _descriptor = descriptor
+    _lattice = lattice
+    return lattice
+
+
+def _views(buf, N, M):
+    coords = np.ndarray((N, 2), dtype=np.float64, buffer=buf)
+    indptr = np.ndarray(N+1, dtype=np.int64, buffer=buf, offset=coords.nbytes)
+    indices = np.ndarray(M, dtype=np.int64, buffer=buf, offset=coords.nbytes+indptr.nbytes)
+    return coords, indptr, indices
+
+
+# Determines a single path in a worker.
+# task ... (mode, start, end, blocker sites, banned sites, avoid_1nn, avoid_2nn), mode is 'direct' or 'unblocked'
+# Returns the site indices of the path and its validity.
+def _evaluate(descriptor, task):
+    lattice = _attach(descriptor)
+    sites = lattice.sites
+    mode, start, end, blockers, banned, avoid_1nn, avoid_2nn = task
+    path = paths.Path(sites[start], sites[end], list_blockers=[aab.Atom(sites[i], None) for i in blockers],
+                      list_banned=[sites[i] for i in banned], avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
+    if mode == 'direct':
+        path.determine_direct_path()
+        sitelist = path.sitelist_direct
+    else:
+        path.determine_unblocked_path()
+        sitelist = path.sitelist
+    return [x.index for x in sitelist], path.is_valid
+
+
+class PathPool(object):
+    # max_workers ... number of worker processes, default: number of processors
+
+    def __init__(self, max_workers=None):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker)
+        self.lock = threading.Lock()
+        self.lattice = None
+        self.indices = None
+        self.descriptor = None
+        self.shm = None
+        self.closed = False
+
+    def publish(self, lattice):
+        # Copies the lattice to shared memory, if not done before for the lattice and its current bonds.
+        if lattice is self.lattice and lattice.indices is self.indices:
+            return
+        N = len(lattice.coords)
+        M = len(lattice.indices)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 16*N + 8*(N+1) + 8*M))
+        coords, indptr, indices = _views(shm.buf, N, M)
+        coords[:] = lattice.coords
+        indptr[:] = lattice.indptr
+        indices[:] = lattice.indices
+        del coords, indptr, indices
+
+        self._release()
+        self.shm = shm
+        self.lattice = lattice
+        self.indices = lattice.indices
+        self.descriptor = (shm.name, N, M)
+
+    def evaluate(self, jobs):
+        # Determines the paths concurrently.
+        # jobs ... list of (class member of "Path", mode), mode is 'direct' or 'unblocked'
+        # The results are written into the paths as their sequential evaluation would do.
+        if len(jobs) == 0:
+            return
+        lattice = jobs[0][0].start.lattice
+        try:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError("Path pool closed.")
+                self.publish(lattice)
+                futures = []
+                for path, mode in jobs:
+                    task = (mode, path.start.index, path.end.index, [b.site.index for b in path.list_blockers],
+                            [x.index for x in path.list_banned], path.avoid_1nn, path.avoid_2nn)
+                    futures.append(self.executor.submit(_evaluate, self.descriptor, task))
+            results = [future.result() for future in futures]
+        except (RuntimeError, OSError, CancelledError): # Closed meanwhile or broken pool.
+            for path, mode in jobs:
+                if mode == 'direct':
+                    path.determine_direct_path()
+                else:
+                    path.determine_unblocked_path()
+            return
+
+        sites = lattice.sites
+        for (path, mode), (sitelist, is_valid) in zip(jobs, results):
+            sitelist = [sites[i] for i in sitelist]
+            if mode == 'direct':
+                path.sitelist_direct = sitelist
+            else:
+                path.sitelist = sitelist
+            path.is_valid = is_valid
+
+    def close(self):
+        # Stops the workers and releases the shared memory. Can be called more than once.
+        with self.lock:
+            self.closed = True
+            self.executor.shutdown(wait=False)
+            self._release()
+            self.lattice = None
+            self.indices = None
+
+    def _release(self):
+        if self.shm is not None:
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = None
@@ -4,7 +4,19 @@
 import numpy as np
 import logging
 import copy
-from scipy.optimize import linear_sum_assignment as lsa
+import heapq
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from scipy import sparse
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching, shortest_path
+from scipy.spatial import cKDTree
+
+# Number of atom-target pairs above which the assignment is restricted to pairs within the cutoff, if given.
+SPARSE_ASSIGNMENT_THRESHOLD = 10000
+# Number of target sites per batch of the breadth-first search for hop distances (bounds the memory).
+HOP_DISTANCE_BATCH_SIZE = 32
 
 class Path(object):
     
@@ -21,6 +33,8 @@ class Path(object):
         self.list_banned = np.array(list_banned)
         self.sitelist = np.array([])
         self.blocked_by = np.array([])
+        # masks over the sites of the lattice (see update_masks)
+        self.lattice = None
         # flags
         self.is_subpath = is_subpath
         self.is_valid = None
@@ -80,29 +94,52 @@ class Path(object):
 
         return out
             
-    def blocked(self):
-        out = np.array([])
-        caused_by = np.array([])
-       
-        for b in self.list_blockers:
-            tmp = np.array([])
-            tmp = np.append(tmp, b.site)
-
-            # If nearest neighbors are also configured to block.
-            if self.avoid_1nn:
-                tmp = np.append(tmp, b.site.neighbors)
-
-                # If second-nearest neighbors are also configured to block.
-                if self.avoid_2nn:
-                    for n in b.site.neighbors:
-                        tmp = np.append(tmp, n.neighbors)
-
-            # Condition output.
-            out = np.append(out, tmp)
-            caused_by = np.append(caused_by, np.repeat(b, len(tmp)))
-
-        return out, caused_by
-
+    def update_masks(self):
+        # Boolean masks over the sites of the lattice. They are computed once per path and updated incrementally
+        # for the blockers that moved since (see Atom.move).
+        # banned_mask ... banned sites and, if configured, their nearest and second-nearest neighbors
+        # banned_site_mask ... banned sites only
+        # blocked_mask ... sites of the blockers and, if configured, their nearest and second-nearest neighbors
+        # caused_by ... index of the first blocker in list_blockers that blocks the site, or -1
+        lattice = self.start.lattice
+        depth = (2 if self.avoid_2nn else 1) if self.avoid_1nn else 0
+
+        if self.lattice is not lattice:
+            self.lattice = lattice
+            N = len(lattice)
+            banned = np.array([x.index for x in self.list_banned], dtype=np.intp)
+            self.banned_site_mask = np.zeros(N, dtype=bool)
+            self.banned_site_mask[banned] = True
+            self.banned_mask = lattice.neighborhood(banned, depth)
+            self.blocked_mask = np.zeros(N, dtype=bool)
+            self.caused_by = np.full(N, -1, dtype=np.intp)
+            self.block_count = np.zeros(N, dtype=np.intp) # Number of blockers blocking the site.
+            self.blocker_sites = np.full(len(self.list_blockers), -1, dtype=np.intp)
+            self.blocker_zones = [np.empty(0, dtype=np.intp) for _ in self.list_blockers]
+
+        blocker_sites = np.array([b.site.index for b in self.list_blockers], dtype=np.intp)
+        moved = np.nonzero(blocker_sites != self.blocker_sites)[0]
+        if len(moved) == 0:
+            return
+
+        affected = np.zeros(len(lattice), dtype=bool)
+        for k in moved:
+            zone = self.blocker_zones[k]
+            self.block_count[zone] -= 1
+            affected[zone] = True
+            zone = lattice.neighborhood_indices(blocker_sites[k], depth)
+            self.block_count[zone] += 1
+            affected[zone] = True
+            self.blocker_zones[k] = zone
+        self.blocker_sites = blocker_sites
+        self.blocked_mask[affected] = self.block_count[affected] > 0
+
+        # The first blocker wins.
+        self.caused_by[affected] = -1
+        for k in range(len(self.blocker_zones)-1, -1, -1):
+            zone = self.blocker_zones[k]
+            zone = zone[affected[zone]]
+            self.caused_by[zone] = k
 
     def direct_path_blocked_old(self):
         blocker0, blocker1, blocker2 = self.blocking_sites()
@@ -179,141 +216,125 @@ class Path(object):
             self.is_valid = True
             return None
 
-        if self.debug_print:
-            print(self.start.neighbors)
-
-        it = 0
-
-        banned_sites_tmp = self.banned_sites()
-
-        while (self.sitelist_direct[-1].id != self.end.id) and (it <= 200):
-            it += 1 # Endless loop protection.
-            d = np.infty
-            highest_rated_neighbor = None
-
-            for candidate in self.sitelist_direct[-1].neighbors:
-                # Exclude any double occurence and forbid the banned sites.
-
-                #if (candidate in self.sitelist_direct) or (candidate in self.list_banned):
-                if (candidate in self.sitelist_direct) or (candidate in banned_sites_tmp):
-                    continue
-                
-                # d_tilde ... Cost equivalent
-                d_tilde = candidate.distance(self.end)
-
-                # Downrate the path at an edge or through a two-coordinated atom (lattice defect?) by 10 percent.
-                if len(candidate.neighbors) < 3:
-                    d_tilde *= 1.1
-
-                # Refresh highest rated neighbor.
-                if d_tilde < d:
-                    d = d_tilde
-                    highest_rated_neighbor = candidate
+        if self.start.lattice is None or self.end.lattice is not self.start.lattice:
+            print(" No allowed unblocked path")
+            self.is_valid = False
+            return None
 
-            if not highest_rated_neighbor:
-                print(" Going back due to a banned site: No allowed neighbor found")
-                banned_sites_tmp.append(self.sitelist_direct[-1])
-                self.sitelist_direct.remove(self.sitelist_direct[-1])
+        self.update_masks()
 
-            else:
-                self.sitelist_direct.append(highest_rated_neighbor)
-            
-            if len(self.sitelist_direct) == 0:
-                print(" No allowed unblocked path")
-                self.is_valid = False
-                return None
+        sitelist = self.search(~self.banned_mask)
+        if sitelist is None:
+            print(" No allowed unblocked path")
+            self.is_valid = False
+            return None
 
+        self.sitelist_direct = sitelist
         self.is_valid = True
 
     def determine_unblocked_path(self):
 
         self.sitelist = list([self.start]) # No legality check for the starting point.
 
-        self.candidates_d_tilde = list() # List with cost equivalents (= d_tilde).
-        self.calculated_Flags = list() # Flags if calculations were already done.
-
         if self.start == self.end:
             logging.info("  Info: Starting site and end site are equal.")
             self.is_valid = True
             return None
 
-        if self.debug_print:
-            print(self.start.neighbors)
-
-        it = 0
-
-        while (self.sitelist[-1].id != self.end.id) and (it <= 200):
-            it += 1 # Endless loop protection.
-
-            path_depth = len(self.sitelist)-1 # Current path depth.
-
-            if len(self.calculated_Flags) <= path_depth:
-                self.calculated_Flags.append(False)
-                self.candidates_d_tilde.append(None)
-            
-            if self.calculated_Flags[path_depth] is not True:
-
-                self.candidates_d_tilde[path_depth] = np.full(len(self.sitelist[-1].neighbors), np.infty)
-
-                for i, candidate in enumerate(self.sitelist[-1].neighbors):
+        if self.start.lattice is None or self.end.lattice is not self.start.lattice:
+            print(" No allowed unblocked path")
+            self.is_valid = False
+            return None
 
-                    # Here, do not allow going back.
-                    if (candidate in self.sitelist) or (candidate in self.list_banned):
-                        continue
+        self.update_masks()
+        allowed = ~(self.banned_site_mask | self.blocked_mask)
+
+        # Approaches to a blocked position are not allowed, except if end is a blocking site.
+        # Then, a blocked site may be entered if it is closer to end than to the blocker causing the end to be blocked.
+        k = self.caused_by[self.end.index]
+        if k >= 0:
+            coords = self.lattice.coords
+            idx = np.nonzero(self.blocked_mask & ~self.banned_site_mask)[0]
+            remaining_distance = np.linalg.norm(coords[idx] - self.end.coords, axis=1)
+            blocker_distance = np.linalg.norm(coords[idx] - self.list_blockers[k].site.coords, axis=1)
+            allowed[idx[remaining_distance < blocker_distance*0.9]] = True
+
+        sitelist = self.search(allowed)
+        if sitelist is None:
+            print(" No allowed unblocked path")
+            self.is_valid = False
+            return None
 
-                    blocking_sites_tmp, caused_by = self.blocked()
+        self.sitelist = sitelist
+        self.is_valid = True
 
-                    # Do not allow approaches to a blocked position, except if end is a blocking site.
-                    if candidate in blocking_sites_tmp:
-                        
-                        idx = np.nonzero(self.end==blocking_sites_tmp)
+    def search(self, allowed):
+        # A* search from start to end over the bonds of the lattice.
+        # allowed ... boolean mask over the sites, False for sites that must not be entered
+        # Returns the list of sites or None if end is unreachable.
+        lattice = self.start.lattice
+        out = a_star(lattice, self.start.index, self.end.index, allowed)
+        if out is None:
+            return None
+        return [lattice.sites[i] for i in out]
+
+
+# A* search over the bonds of a lattice [Hart, Nilsson & Raphael (1968)].
+# Paths are optimal in their number of hops. Among paths with equally many hops, the one with the least cost is
+# chosen, where entering an under-coordinated site (edge or lattice defect, less than 3 neighbors) costs 1.1 and
+# any other site costs 1. Remaining ties are broken by the Euclidean distance to the end (formerly the greedy
+# rating). The heuristic is the Euclidean distance to the end in units of the longest bond, which is a lower
+# bound for the remaining number of hops.
+# allowed ... boolean mask over the sites, False for sites that must not be entered (the start is always allowed)
+# Returns the list of site indices from start to end or None if end is unreachable.
+def a_star(lattice, start, end, allowed):
+    indptr, indices = lattice.indptr, lattice.indices
+    x, y = lattice.coords[:, 0], lattice.coords[:, 1]
+    x_end, y_end = x[end], y[end]
+    step = lattice.longest_bond if lattice.longest_bond > 0 else 1.
+
+    def rating(i):
+        d = math.hypot(x[i] - x_end, y[i] - y_end)
+        d_tilde = d*1.1 if indptr[i+1] - indptr[i] < 3 else d
+        return d/step, d_tilde
+
+    cost = {start: (0, 0.)} # (hops, cost)
+    parent = {start: -1}
+    closed = set()
+    h, d_tilde = rating(start)
+    heap = [(h, 0., d_tilde, start)]
+
+    while heap:
+        _, _, _, i = heapq.heappop(heap)
+        if i in closed:
+            continue
+        if i == end:
+            out = []
+            while i >= 0:
+                out.append(i)
+                i = parent[i]
+            return out[::-1]
+        closed.add(i)
+
+        hops, c = cost[i]
+        for j in indices[indptr[i]:indptr[i+1]].tolist():
+            if j in closed or not allowed[j]:
+                continue
+            h, d_tilde = rating(j)
+            cost_j = (hops + 1, c + (1.1 if indptr[j+1] - indptr[j] < 3 else 1.))
+            if j not in cost or cost_j < cost[j]:
+                cost[j] = cost_j
+                parent[j] = i
+                heapq.heappush(heap, (cost_j[0] + h, cost_j[1], d_tilde, j))
 
-                        if len(idx[0]) > 0: # Here, self.end is in blocking_sites_tmp.
-                            remaining_distance = candidate.distance(self.end)
-                            if remaining_distance < candidate.distance(caused_by[idx][0].site)*0.9:
-                                pass
-                            else:
-                                continue
-                        else:
-                            continue
-                
-                # d_tilde ... Cost equivalent
-                    self.candidates_d_tilde[path_depth][i] = candidate.distance(self.end)
-
-                # Downrate the path at an edge or through a two-coordinated atom (lattice defect?) by 10 percent.
-                    if len(candidate.neighbors) < 3:
-                        self.candidates_d_tilde[path_depth][i] *= 1.1
-
-                self.calculated_Flags[path_depth] = True
-
-            # Refresh highest rated candidate.
-            d_min = np.min(self.candidates_d_tilde[path_depth])
-            if d_min < np.infty:
-                highest_rated_candidate = self.sitelist[-1].neighbors[np.argmin(self.candidates_d_tilde[path_depth])]
-                self.sitelist.append(highest_rated_candidate)
-                try:
-                    self.calculated_Flags[path_depth+1] = False
-                except:
-                    pass
-            else:
-                highest_rated_candidate = None
-                print("  Going back: No allowed neighbor found")
-                # Cost equivalents from previous candidates.
-                d_tilde_parent = self.candidates_d_tilde[path_depth-1]
-                # Do not allow the highest rated previous candidate any more.
-                self.candidates_d_tilde[path_depth-1][np.argmin(d_tilde_parent)] = np.infty
-                self.sitelist.remove(self.sitelist[-1])
-
-            if len(self.sitelist) == 0:
-                print(" No allowed unblocked path")
-                self.is_valid = False
-                return None
+    return None
 
-        self.is_valid = True
     
 class Paths(object):
     
-    def __init__(self, atoms, target_sites):
+    def __init__(self, atoms, target_sites, assignment_cutoff=None, cost_metric='euclidean'):
+        # assignment_cutoff ... max. distance of an atom to its target site for large problems, in pixels (optional)
+        # cost_metric ... 'euclidean' or 'hops' (lattice hop distance) as assignment costs
         self.debug_print = False # Some lines with print commands are inserted for debugging.
         
         self.members = np.array([]) # numpy.ndarray of class member "Path".
@@ -331,7 +352,8 @@ class Paths(object):
         self.swapped_pairs = []
         
         # First determine atom-target assignment.
-        self.atoms_ordered_idx, self.target_sites_ordered_idx, cost = self.lap_hungarian()
+        self.atoms_ordered_idx, self.target_sites_ordered_idx, cost = self.lap_hungarian(cutoff=assignment_cutoff,
+                                                                                         cost_metric=cost_metric)
         
         # Then sort the atom-target-pairs in ascending order w.r.t. distance.
         self.build_succession(cost)
@@ -353,7 +375,7 @@ class Paths(object):
             txt = site.output_info()
             print(txt)
         
-    def lap_hungarian(self):
+    def lap_hungarian(self, cutoff=None, cost_metric='euclidean'):
         #  ----------- scipy.optimize.linear_sum_assignment ---------
         #  https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.linear_sum_assignment.html
         #
@@ -382,18 +404,84 @@ class Paths(object):
 
         ## Asymmetrical problem
         # Computational effort is raised by (max(M,N) choose min(M,N)) if M is uneqal to N
+        from scipy.optimize import linear_sum_assignment as lsa # Imported on first use.
         M = len(self.atoms)
         N = len(self.target_sites)
 
+        #  Large problems with a cutoff are solved on the sparse bipartite graph of all pairs within the cutoff
+        #  (scipy.sparse.csgraph.min_weight_full_bipartite_matching, LAPJVsp). If not all atoms or targets can be
+        #  assigned within the cutoff, the dense problem is solved instead.
+        #  cutoff ... max. distance of an atom to its target site in pixels, None for the dense problem
+        #  cost_metric ... 'euclidean' or 'hops' (see hop_distances, always solved as dense problem)
+        atom_coords = np.array([x.site.coords for x in self.atoms], dtype=float).reshape(-1, 2)
+        target_coords = np.array([x.coords for x in self.target_sites], dtype=float).reshape(-1, 2)
+
+        if cost_metric == 'hops':
+            C = self.hop_distances()
+            if C is not None:
+                row_ind, col_ind = lsa(C)
+                return np.array(row_ind, dtype=int), np.array(col_ind, dtype=int), C[row_ind, col_ind]
+            logging.info("Hop distances not available. Using Euclidean distances.")
+        elif cost_metric != 'euclidean':
+            raise ValueError(f"Unknown cost metric '{cost_metric}'.")
+
+        if cutoff is not None and M*N > SPARSE_ASSIGNMENT_THRESHOLD:
+            # Distances are shifted by 1, since all pairs of a full matching are counted and zero distances
+            # would be dropped from the sparse matrix.
+            C = cKDTree(atom_coords).sparse_distance_matrix(cKDTree(target_coords), cutoff, output_type='coo_matrix')
+            C.data += 1
+            try:
+                row_ind, col_ind = min_weight_full_bipartite_matching(C.tocsr())
+            except ValueError:
+                logging.info("No full assignment within the cutoff. Solving the dense problem.")
+            else:
+                cost = np.linalg.norm(atom_coords[row_ind] - target_coords[col_ind], axis=1)
+                return np.array(row_ind, dtype=int), np.array(col_ind, dtype=int), cost
+
         # Cost matrix
-        C = np.zeros((M, N))
-        for i in range(M):
-            for j in range(N):
-                C[i, j] = self.atoms[i].site.distance(self.target_sites[j])
+        C = np.linalg.norm(atom_coords[:, np.newaxis, :] - target_coords[np.newaxis, :, :], axis=2)
         row_ind, col_ind = lsa(C)
 
         return np.array(row_ind, dtype=int), np.array(col_ind, dtype=int), C[row_ind, col_ind]
         
+    def hop_distances(self):
+        # Cost matrix of the lattice hop distances between atoms (rows) and target sites (columns).
+        # All distances are found by one breadth-first search from the target sites over the bonds, in batches of
+        # HOP_DISTANCE_BATCH_SIZE target sites. Four-coordinated atoms are banned (see determine_paths_no_collision),
+        # so their sites are removed from the graph. Unreachable pairs cost more than any reachable pair, with
+        # their Euclidean distance in units of the longest bond added to keep far pairs less favorable.
+        # Returns None if the sites do not share a lattice.
+        sites = [x.site for x in self.atoms] + list(self.target_sites)
+        lattice = sites[0].lattice if len(sites) > 0 else None
+        if lattice is None or any(x.lattice is not lattice for x in sites):
+            return None
+
+        N_sites = len(lattice)
+        atom_idx = np.array([x.site.index for x in self.atoms], dtype=np.intp)
+        target_idx = np.array([x.index for x in self.target_sites], dtype=np.intp)
+
+        keep = np.ones(N_sites)
+        keep[[x.site.index for x in self.atoms_four_coordinated]] = 0
+        keep = sparse.diags(keep)
+        graph = sparse.csr_matrix((np.ones(len(lattice.indices)), lattice.indices, lattice.indptr),
+                                  shape=(N_sites, N_sites))
+        graph = keep @ graph @ keep
+        graph.eliminate_zeros()
+
+        C = np.empty((len(atom_idx), len(target_idx)))
+        for start in range(0, len(target_idx), HOP_DISTANCE_BATCH_SIZE):
+            batch = target_idx[start:start+HOP_DISTANCE_BATCH_SIZE]
+            distances = shortest_path(graph, directed=False, unweighted=True, indices=batch)
+            C[:, start:start+len(batch)] = distances[:, atom_idx].T
+
+        unreachable = ~np.isfinite(C)
+        if np.any(unreachable):
+            step = lattice.longest_bond if lattice.longest_bond > 0 else 1.
+            euclidean = np.linalg.norm(lattice.coords[atom_idx][:, np.newaxis, :] -
+                                       lattice.coords[target_idx][np.newaxis, :, :], axis=2)/step
+            C[unreachable] = N_sites + euclidean[unreachable]
+        return C
+
     def build_succession(self, cost):
         cost_ordered_idx = np.argsort(cost) # Indices sorted by cost.
         self.atoms_ordered_idx = self.atoms_ordered_idx[cost_ordered_idx]
@@ -408,7 +496,32 @@ class Paths(object):
             self.members[-1].determine_direct_path()
         logging.info("%d paths determined." % len(self.members))
     
-    def determine_paths_no_collision(self, avoid_1nn=True, avoid_2nn=True):
+    def direct_path(self, path, direct_paths):
+        # Determines the direct path, or takes it from direct_paths (see prefetch_direct_paths).
+        key = (path.start.index, path.end.index)
+        if key in direct_paths:
+            sitelist, path.is_valid = direct_paths[key]
+            path.sitelist_direct = list(sitelist)
+        else:
+            path.determine_direct_path()
+            direct_paths[key] = (list(path.sitelist_direct), path.is_valid)
+
+    def prefetch_direct_paths(self, k, a_banlist, avoid_1nn, avoid_2nn, pool, direct_paths):
+        # Direct paths of the atoms k, k+1, ... from their current sites to their current targets, evaluated
+        # concurrently in one batch. A direct path only avoids the banned sites, so it does not depend on the other
+        # atoms and stays valid as long as the atom and its target are unchanged.
+        jobs = dict()
+        for atom, target in zip(self.atoms[k:], self.target_sites[k:]):
+            key = (atom.site.index, target.index)
+            if key not in direct_paths and key not in jobs:
+                jobs[key] = Path(atom.site, target, list_banned=a_banlist, avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
+        pool.evaluate([(path, 'direct') for path in jobs.values()])
+        for key, path in jobs.items():
+            direct_paths[key] = (list(path.sitelist_direct), path.is_valid)
+
+    def determine_paths_no_collision(self, avoid_1nn=True, avoid_2nn=True, pool=None):
+        # pool ... class member of "path_pool.PathPool" to evaluate the direct paths of all atoms concurrently (optional)
+        direct_paths = dict() # (start, end) site indices -> (sites, validity) of the direct path
         k = 0
         while k < len(self.atoms):
 
@@ -417,6 +530,9 @@ class Paths(object):
         
             a_blocker_list = np.delete(self.atoms, k) # List of (potential) blockers.
             a_banlist = [x.site for x in self.atoms_four_coordinated] # List of banned sites without neighbors being banned.
+
+            if pool is not None and (self.atoms[k].site.index, self.target_sites[k].index) not in direct_paths:
+                self.prefetch_direct_paths(k, a_banlist, avoid_1nn, avoid_2nn, pool, direct_paths)
             
             if self.debug_print:
                 print("=== Potential blockers ===")
@@ -429,7 +545,7 @@ class Paths(object):
             self.atoms[k].main_path = path_to_be_evaluated # ## EXPERIMENTAL
             
             ## New no collision algorithm.
-            path_to_be_evaluated.determine_direct_path()
+            self.direct_path(path_to_be_evaluated, direct_paths)
             N_steps_direct = len(path_to_be_evaluated.sitelist_direct)-1
             block_codes_and_sites = path_to_be_evaluated.direct_path_blocked()
 
@@ -488,7 +604,7 @@ class Paths(object):
 
                             subpath = Path(block_atom.site, self.target_sites[block_atom_idx], is_subpath=True, list_banned=a_banlist,
                                             avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
-                            subpath.determine_direct_path()
+                            self.direct_path(subpath, direct_paths)
                             subpath.sitelist = subpath.sitelist_direct
 
                             # Move atom in backend.
@@ -503,7 +619,7 @@ class Paths(object):
                             path_to_be_evaluated = Path(self.atoms[k].site, self.target_sites[k], list_blockers=a_blocker_list, list_banned=a_banlist,
                                                         avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
 
-                            path_to_be_evaluated.determine_direct_path()
+                            self.direct_path(path_to_be_evaluated, direct_paths)
                             path_to_be_evaluated.sitelist = path_to_be_evaluated.sitelist_direct
                             self.atoms[k].main_path = path_to_be_evaluated # ## EXPERIMENTAL
                             block_codes_and_sites = path_to_be_evaluated.direct_path_blocked()
@@ -585,20 +701,19 @@ class Paths(object):
 
                             subpath = Path(block_atom.site, subpath_target_site, is_subpath=True, list_banned=a_banlist,
                                             avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
-                            subpath.determine_direct_path()
-                            subpath.sitelist = subpath.sitelist_direct
-                            N0 = len(subpath.sitelist)-1 
-
                             path_proposed = Path(self.atoms[k].site, proposed_target_site, list_blockers=np.delete(self.atoms, [k, block_atom_idx]), list_banned=a_banlist,
                                                     avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
-                            path_proposed.determine_direct_path()
-                            path_proposed.sitelist = path_proposed.sitelist_direct
-                            N1 = len(path_proposed.sitelist)-1
-
                             # The length of the planned path for block_atom is calculated for comparison.
                             planned_block_path = Path(block_atom.site, self.target_sites[block_atom_idx], list_banned=a_banlist,
                                             avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
-                            planned_block_path.determine_direct_path()
+                            self.direct_path(subpath, direct_paths)
+                            self.direct_path(path_proposed, direct_paths)
+                            self.direct_path(planned_block_path, direct_paths)
+
+                            subpath.sitelist = subpath.sitelist_direct
+                            N0 = len(subpath.sitelist)-1 
+                            path_proposed.sitelist = path_proposed.sitelist_direct
+                            N1 = len(path_proposed.sitelist)-1
                             N_planned = len(planned_block_path.sitelist_direct)-1
 
                             if (N_steps_unblocked+N_planned) <= (N0+N1): # Here, unblocked path is smaller or equal than the compound path.
@@ -660,6 +775,7 @@ class Paths(object):
             if not path.is_subpath and path.is_valid:
                 N += 1
         logging.info("%d valid paths determined:" % N)
+        logging.info("%d moves in total." % self.count_moves())
 
         # Print all paths
         i = 0
@@ -670,3 +786,215 @@ class Paths(object):
             else:
                 prepend_text = "Reassignment"
             path.print_sitelist(prepend_text=prepend_text)
+
+    def count_moves(self):
+        # Total number of moves (hops) of all valid paths, including reassignments.
+        self.total_moves = 0
+        for path in self.members:
+            if path.is_valid:
+                self.total_moves += len(path.sitelist)-1
+        return self.total_moves
+
+    def determine_paths_prioritized(self, avoid_1nn=True, avoid_2nn=True, time_limit=1.):
+        # Prioritized planning [Erdmann, M. & Lozano-Perez, T. Algorithmica 2, 477-521 (1987)], an alternative
+        # to determine_paths_no_collision.
+        # The atoms are moved one after another, so the time slots of the reservation table are the positions in
+        # the order of priority: in its slot, an atom has to avoid the targets of all atoms moved before and the
+        # origins of all atoms moved after (including their nearest and second-nearest neighbors, if configured).
+        # Each atom is planned once per order with an optimal A* search. If an atom finds no path, the order is
+        # changed and planned again: the atom whose origin blocks the target is moved ahead, otherwise the atom
+        # itself gets the highest priority. Orders are never repeated and planning stops after time_limit seconds,
+        # so the planning time is bounded. The order with the most valid paths and, second, the fewest moves wins.
+        # time_limit ... in seconds
+        t_start = time.time()
+        K = len(self.atoms)
+        origins = [x.site for x in self.atoms]
+        a_banlist = [x.site for x in self.atoms_four_coordinated] # List of banned sites without neighbors being banned.
+
+        order = list(range(K)) # Ascending w.r.t. distance (see build_succession).
+        tried = set()
+        best = None
+        while tuple(order) not in tried:
+            tried.add(tuple(order))
+
+            # Start from the origins.
+            for atom, origin in zip(self.atoms, origins):
+                atom.move(origin)
+
+            members = []
+            failed = None
+            for slot, k in enumerate(order):
+                a_blocker_list = [self.atoms[j] for j in order if j != k] # At their positions in this slot.
+                path = Path(origins[k], self.target_sites[k], list_blockers=a_blocker_list, list_banned=a_banlist,
+                            avoid_1nn=avoid_1nn, avoid_2nn=avoid_2nn)
+                path.determine_unblocked_path()
+                self.atoms[k].move(path.sitelist[-1])
+                self.atoms[k].main_path = path
+                members.append(path)
+                if not path.is_valid and failed is None:
+                    failed = (slot, path)
+
+            N_valid = sum(path.is_valid for path in members)
+            N_moves = sum(len(path.sitelist)-1 for path in members if path.is_valid)
+            if best is None or (N_valid, -N_moves) > (best[0], -best[1]):
+                best = (N_valid, N_moves, list(order), members)
+
+            if failed is None or time.time()-t_start > time_limit:
+                break
+
+            # Change the order of priority.
+            slot, path = failed
+            k = order[slot]
+            blocker = path.caused_by[path.end.index] if path.lattice is not None else -1
+            order.remove(k)
+            if blocker >= 0 and path.list_blockers[blocker] in [self.atoms[j] for j in order[slot:]]:
+                # The origin of an atom moved later blocks the target. Move that atom just ahead.
+                j = self.atoms.tolist().index(path.list_blockers[blocker])
+                order.remove(j)
+                order.insert(slot, j)
+                order.insert(slot+1, k)
+            else:
+                order.insert(0, k)
+
+        N_valid, N_moves, order, members = best
+        self.atoms = self.atoms[order]
+        self.target_sites = self.target_sites[order]
+        for atom, path in zip(self.atoms, members):
+            atom.main_path = path
+            atom.move(path.sitelist[-1])
+        self.members = np.array(members)
+        self.count_moves()
+
+        logging.info("%d valid paths determined (prioritized planning, %d orders in %.5f seconds):" %
+                     (N_valid, len(tried), time.time()-t_start))
+        logging.info("%d moves in total." % self.total_moves)
+        for i, path in enumerate(self.members):
+            path.print_sitelist(prepend_text="Path " + f"{i+1}")
+
+    def to_plan(self, atoms, target_sites):
+        # Compact description of the paths by site indices, e.g. for caching (see PlanCache).
+        # atoms, target_sites ... lists the paths were determined for (see __init__)
+        atom_pos = {id(x): i for i, x in enumerate(atoms)}
+        target_pos = {id(x): i for i, x in enumerate(target_sites)}
+        member_pos = {id(x): i for i, x in enumerate(self.members)}
+        return {'atoms': [atom_pos[id(x)] for x in self.atoms],
+                'atoms_four_coordinated': [atom_pos[id(x)] for x in self.atoms_four_coordinated],
+                'target_sites': [target_pos[id(x)] for x in self.target_sites],
+                'atom_sites': [x.site.index for x in self.atoms],
+                'main_paths': [member_pos.get(id(x.main_path), -1) for x in self.atoms],
+                'members': [(path.start.index, path.end.index, [x.index for x in path.sitelist],
+                             path.is_subpath, path.is_valid) for path in self.members]}
+
+    @staticmethod
+    def from_plan(plan, atoms, target_sites):
+        # Paths rebound from a plan (see to_plan) to the given atoms, target sites and their lattice.
+        lattice = target_sites[0].lattice if len(target_sites) > 0 else atoms[0].origin.lattice
+        sites = lattice.sites
+        paths = Paths.__new__(Paths)
+        paths.debug_print = False
+        paths.swapped_pairs = []
+        paths.atoms = np.array([atoms[i] for i in plan['atoms']])
+        paths.atoms_four_coordinated = np.array([atoms[i] for i in plan['atoms_four_coordinated']])
+        paths.target_sites = np.array([target_sites[i] for i in plan['target_sites']])
+
+        members = []
+        for start, end, sitelist, is_subpath, is_valid in plan['members']:
+            path = Path(sites[start], sites[end], is_subpath=is_subpath)
+            path.sitelist = [sites[i] for i in sitelist]
+            path.sitelist_direct = path.sitelist
+            path.is_valid = is_valid
+            members.append(path)
+        paths.members = np.array(members)
+
+        for atom in atoms:
+            atom.site = atom.origin
+        for atom, site, main_path in zip(paths.atoms, plan['atom_sites'], plan['main_paths']):
+            atom.site = sites[site]
+            atom.main_path = members[main_path] if main_path >= 0 else None
+        paths.count_moves()
+        return paths
+
+
+# Bounded cache of planned paths with least-recently-used eviction.
+# Plans are keyed on the persistent IDs (see SiteTracker) of the sites of the atoms and targets and the planning
+# options. They are stored by site IDs together with a signature of the bonds near the planned paths (within depth
+# bonds of any site of the paths). On a lookup, the plan is valid if all of its sites still exist and the bonds near
+# it are unchanged; it is then rebound to the sites of the current lattice. Position jitter and changes elsewhere in
+# the lattice do not invalidate a plan, so consecutive frames of a stable lattice skip planning. Lattices without
+# persistent IDs are not cached.
+class PlanCache(object):
+    # max_size ... max. number of stored plans
+    # depth ... neighborhood of the paths (in bonds) whose bonds must be unchanged, 2 covers the avoided 2nn
+
+    def __init__(self, max_size=16, depth=2):
+        self.max_size = max_size
+        self.depth = depth
+        self.plans = OrderedDict() # key -> (plan by site IDs, IDs of the sites of the plan, bond signature)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.plans)
+
+    def clear(self):
+        self.plans.clear()
+
+    def fingerprint(self, atoms, target_sites, **options):
+        # Returns the key for the inputs of Paths and the planning options, or None if the sites do not share
+        # a tracked lattice.
+        sites = [x.origin for x in atoms] + list(target_sites)
+        lattice = sites[0].lattice if len(sites) > 0 else None
+        if lattice is None or lattice.ids is None or any(x.lattice is not lattice for x in sites):
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(lattice.ids[[x.index for x in sites]].astype(np.int64).tobytes())
+        h.update(repr((len(atoms), sorted(options.items()))).encode())
+        return h.hexdigest()
+
+    def bond_signature(self, lattice, idx):
+        # Hash of the bonds (as pairs of site IDs) with a site within {depth} bonds of the sites idx.
+        near = lattice.neighborhood(idx, self.depth)
+        pairs = lattice.pairs[near[lattice.pairs[:, 0]] | near[lattice.pairs[:, 1]]]
+        pairs = np.sort(lattice.ids[pairs].reshape(-1, 2), axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        return hashlib.blake2b(pairs.astype(np.int64).tobytes(), digest_size=16).hexdigest()
+
+    def get(self, key, atoms, target_sites):
+        # Returns the cached paths rebound to the atoms and target sites, or None.
+        if key is None or key not in self.plans:
+            self.misses += 1
+            return None
+        plan, plan_ids, signature = self.plans[key]
+        lattice = target_sites[0].lattice if len(target_sites) > 0 else atoms[0].origin.lattice
+        index_of = dict(zip(lattice.ids.tolist(), range(len(lattice))))
+        idx = [index_of.get(x) for x in plan_ids.tolist()]
+        if any(x is None for x in idx) or self.bond_signature(lattice, idx) != signature:
+            del self.plans[key] # Stale: sites vanished or bonds near the paths changed.
+            self.misses += 1
+            return None
+        self.plans.move_to_end(key)
+        self.hits += 1
+        return Paths.from_plan(PlanCache.map_sites(plan, index_of.__getitem__), atoms, target_sites)
+
+    def put(self, key, paths, atoms, target_sites):
+        if key is None:
+            return
+        lattice = target_sites[0].lattice if len(target_sites) > 0 else atoms[0].origin.lattice
+        plan = paths.to_plan(atoms, target_sites)
+        idx = np.unique(np.array([x.origin.index for x in atoms] + [x.index for x in target_sites] +
+                                 [i for member in plan['members'] for i in member[2]], dtype=np.intp))
+        ids = lattice.ids.tolist()
+        self.plans[key] = (PlanCache.map_sites(plan, ids.__getitem__), lattice.ids[idx],
+                           self.bond_signature(lattice, idx))
+        self.plans.move_to_end(key)
+        while len(self.plans) > self.max_size:
+            self.plans.popitem(last=False)
+
+    @staticmethod
+    def map_sites(plan, f):
+        # Plan (see Paths.to_plan) with the sites mapped by f (site indices <-> site IDs).
+        plan = dict(plan)
+        plan['atom_sites'] = [f(x) for x in plan['atom_sites']]
+        plan['members'] = [(f(start), f(end), [f(x) for x in sitelist], is_subpath, is_valid)
+                           for start, end, sitelist, is_subpath, is_valid in plan['members']]
+        return plan
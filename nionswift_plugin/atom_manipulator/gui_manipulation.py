@@ -6,9 +6,7 @@ import logging
 # Custom libraries
 from . import lib_utils
 from . import lib_structure_recognition
-from . import lib_pathfinding
 from .lib_widgets import Section, line_edit_template, check_box_template, combo_box_template
-from adf_feedback import adf_feedback as adffb
 
 _ = gettext.gettext
 
@@ -64,17 +62,17 @@ class ManipulationModule(lib_utils.AtomManipulatorModule):
                     self.manipulator.snapshot_counter = 1
                 else:
                     self.manipulator.snapshot_counter = None
+                # Runs pathfinding and probe moves as further stages of its pipeline.
                 lib_structure_recognition.analyze_and_show(self.manipulator.structure_recognition_module,
                                                            auto_manipulate=True)
-
-                # Pathfinding.
-                lib_pathfinding.find_paths(self.manipulator, auto_manipulate=True)
                 
                 # Tractor beam (wrapper).
                 try:
                     # In this (auto-manipulation) operation mode, ADFFeedback itself listens to comm_events
                     # and will stop execution accordingly.
                     
+                    from adf_feedback import adf_feedback as adffb # Imported on first use.
+
                     # Communication events.
                     comm_events = [self.manipulator.structure_recognition_module.new_image,
                                    self.manipulator.pathfinding_module.rdy,
@@ -104,6 +102,7 @@ class ManipulationModule(lib_utils.AtomManipulatorModule):
                 automanip_button.text = _('Stop automated manipulation')
             else:
                 self.stop_auto_manipulate_event.set()
+                self.manipulator.tractor_beam_module.rdy.set() # Wake up a waiting acquisition.
                 automanip_button.text = _('Start automated manipulation')
 
         automanip_button.on_clicked = automanip_button_clicked
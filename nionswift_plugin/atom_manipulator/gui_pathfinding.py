@@ -12,7 +12,14 @@ _ = gettext.gettext
 # Defaults on initialization.
 defaults = {'max_bond_length': 2.2, # in Angstroem
             'avoid_1nn': True,      # Avoid nearest neighbors of foreign atoms.
-            'avoid_2nn': True       # Avoid second-nearest neighbors of foreign atoms.
+            'avoid_2nn': True,      # Avoid second-nearest neighbors of foreign atoms.
+            'incremental_bonds': False, # Search bond candidates of consecutive frames only near changed sites
+                                        # (same bonds as a full rebuild).
+            'planner': 0,           # 0: Target swaps, 1: Prioritized planning
+            'hop_distance_costs': False, # Assign target sites by lattice hop distance instead of Euclidean distance.
+            'assignment_cutoff': 20., # in Angstroem, max. atom-target distance in large assignments, 0: no cutoff
+            'parallel_direct_paths': False # Evaluate the direct paths of all atoms on a pool of worker processes
+                                           # (the searches around blockers stay sequential).
         }
 
 
@@ -24,6 +31,11 @@ class PathFindingModule(AtomManipulatorModule):
         self.max_bond_length = None # Internally Nion Swift calculates in nm.
         self.avoid_1nn = None
         self.avoid_2nn = None
+        self.incremental_bonds = None
+        self.planner = None
+        self.hop_distance_costs = None
+        self.assignment_cutoff = None # in Angstroem, None: no cutoff
+        self.parallel_direct_paths = None
         
         # Events.
         self.rdy = threading.Event()
@@ -50,6 +62,20 @@ class PathFindingModule(AtomManipulatorModule):
             self.avoid_1nn = checked
         def avoid_2nn_changed(checked):
             self.avoid_2nn = checked
+        def incremental_bonds_changed(checked):
+            self.incremental_bonds = checked
+        def planner_changed(item):
+            if type(item) == int:
+                item = self.planner_combo_box.items[item]
+            self.planner_combo_box.current_item = item
+            self.planner = self.planner_combo_box.current_index
+        def hop_distance_costs_changed(checked):
+            self.hop_distance_costs = checked
+        def parallel_direct_paths_changed(checked):
+            self.parallel_direct_paths = checked
+            if not checked and self.manipulator.path_pool is not None:
+                self.manipulator.path_pool.close()
+                self.manipulator.path_pool = None
 
         #### GUI elements.
 
@@ -141,6 +167,40 @@ class PathFindingModule(AtomManipulatorModule):
                 finally:
                     self.max_bond_length_line_edit.text = f"{self.max_bond_length:.2f}"
         self.max_bond_length_line_edit.on_editing_finished = max_bond_length_editing_finished
+
+        ## Incremental bond update.
+        incremental_bonds_row, self.incremental_bonds_check_box = check_box_template(
+            self.ui, _('Incremental bond update'))
+        self.incremental_bonds_check_box.on_checked_changed = incremental_bonds_changed
+
+        ## Multi-atom planner.
+        planner_row, self.planner_combo_box = combo_box_template(self.ui, 'Planner',
+                                                                 ['Target swaps', 'Prioritized planning'])
+        self.planner_combo_box.on_current_item_changed = planner_changed
+
+        ## Assignment costs.
+        hop_distance_costs_row, self.hop_distance_costs_check_box = check_box_template(
+            self.ui, _('Assign targets by hop distance'))
+        self.hop_distance_costs_check_box.on_checked_changed = hop_distance_costs_changed
+
+        ## Assignment cutoff.
+        assignment_cutoff_row, self.assignment_cutoff_line_edit = line_edit_template(self.ui,
+                                                                                     'Assignment cutoff [A]')
+        def assignment_cutoff_editing_finished(text):
+            if len(text) > 0:
+                try:
+                    self.assignment_cutoff = float(text) if float(text) > 0 else None
+                except:
+                    pass
+                finally:
+                    self.assignment_cutoff_line_edit.text = \
+                        f"{self.assignment_cutoff:.1f}" if self.assignment_cutoff is not None else "0"
+        self.assignment_cutoff_line_edit.on_editing_finished = assignment_cutoff_editing_finished
+
+        ## Parallel evaluation of direct paths.
+        parallel_direct_paths_row, self.parallel_direct_paths_check_box = check_box_template(
+            self.ui, _('Parallel direct paths'))
+        self.parallel_direct_paths_check_box.on_checked_changed = parallel_direct_paths_changed
         
         ## Other buttons. 
         find_paths_row, self.find_paths_button = push_button_template(self.ui, 'Find paths')
@@ -157,11 +217,24 @@ class PathFindingModule(AtomManipulatorModule):
         avoid_1nn_changed(self.avoid_1nn_check_box.checked)
         self.avoid_2nn_check_box.checked = defaults['avoid_2nn']
         avoid_1nn_changed(self.avoid_2nn_check_box.checked)
+        self.incremental_bonds_check_box.checked = defaults['incremental_bonds']
+        incremental_bonds_changed(self.incremental_bonds_check_box.checked)
+        planner_changed(defaults['planner'])
+        self.hop_distance_costs_check_box.checked = defaults['hop_distance_costs']
+        hop_distance_costs_changed(self.hop_distance_costs_check_box.checked)
+        assignment_cutoff_editing_finished(str(defaults['assignment_cutoff']))
+        self.parallel_direct_paths_check_box.checked = defaults['parallel_direct_paths']
+        parallel_direct_paths_changed(self.parallel_direct_paths_check_box.checked)
 
         # Assemble GUI elements.
         self.section.column.add(foreign_atoms_row)
         self.section.column.add(target_sites_row)
         self.section.column.add(max_bond_length_row)
+        self.section.column.add(incremental_bonds_row)
         self.section.column.add(avoid_1nn_row)
         self.section.column.add(avoid_2nn_row)
+        self.section.column.add(planner_row)
+        self.section.column.add(hop_distance_costs_row)
+        self.section.column.add(assignment_cutoff_row)
+        self.section.column.add(parallel_direct_paths_row)
         self.section.column.add(find_paths_row)
\ No newline at end of file
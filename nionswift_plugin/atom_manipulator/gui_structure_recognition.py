@@ -5,10 +5,6 @@ import numpy as np
 import time
 import logging
 
-# Non-standard packages
-from nionswift_plugin.nionswift_structure_recognition.model import load_preset_model
-from nionswift_plugin.nionswift_structure_recognition.scale import RealSpaceCalibrator
-
 # Custom libraries
 from . import lib_utils
 from . import lib_structure_recognition
@@ -23,7 +19,12 @@ defaults = {'visualize_atoms': True,
             'element_identification_integration_radius_A': 0.25, # in Angstroem
             'element_identification_exponent': 1.64,
             'image_source': 0,   # 0: MAADF, 1: HAADF, 2: Selected data item
-            'scale_calibration_mode': 1 # 0: Manual, 1: Live
+            'scale_calibration_mode': 1, # 0: Manual, 1: Live
+            'cache_calibration': True, # Live: reuse the sampling for the same FOV, frame size, and channel.
+            'calibration_revalidation_interval': 50, # in frames, 0: never
+            'inference_mode': 0, # 0: Full frame, 1: Tiled, 2: ROI around foreign atoms and target sites
+            'out_of_process_inference': False, # Run the NN in a separate worker process.
+            'prefetch_frames': True # Live analysis: acquire the next frame while the current one is analyzed.
             }
 
 
@@ -36,20 +37,32 @@ class StructureRecognitionModule(AtomManipulatorModule):
         self.element_id_int_radius = None
         self.element_id_exponent = None
         self.nn_output = None
+        self.inference_mode = None
+        self.roi_frames = 0 # Frames since the last full-frame inference in ROI mode.
+        self.out_of_process_inference = None
+        self.inference_worker = None
         self.scale_calibration_mode = None
         self.sampling = None
         self.fov = None
+        self.cache_calibration = None
+        self.calibration_revalidation_interval = None
+        self.calibration_cache = None
         self.visualize_atoms = None
         self.live_analysis = None
+        self.prefetch_frames = None
         self.was_playing = None
 
-        self.model = load_preset_model('graphene')
 
         # Events.
         self.stop_live_analysis_event = threading.Event()
         self.rdy = threading.Event()
         self.new_image = threading.Event()
     
+    # Neural network model, shared by all panels. Loaded in the background, waits until loaded on first use.
+    @property
+    def model(self):
+        return lib_structure_recognition.shared_model()
+
     # GUI creation method.
     def create_widgets(self, column):
         section1 = Section(self.ui, 'Scale calibration')     # Scale calibration recognition section.
@@ -92,15 +105,16 @@ class StructureRecognitionModule(AtomManipulatorModule):
             max_sampling = sampling_target_value*1.25
             step_size=(max_sampling-min_sampling)/5
         
-            calibrator = RealSpaceCalibrator(model=self.model,
-                               template='hexagonal',
-                               lattice_constant=2.46, # Graphene (in Angstroem)
-                               min_sampling=min_sampling,
-                               max_sampling=max_sampling,
-                               step_size=step_size
-            )
-            
             def do_this():
+                from nionswift_plugin.nionswift_structure_recognition.scale import RealSpaceCalibrator
+                calibrator = RealSpaceCalibrator(model=self.model, # Waits until the model has been loaded.
+                                   template='hexagonal',
+                                   lattice_constant=2.46, # Graphene (in Angstroem)
+                                   min_sampling=min_sampling,
+                                   max_sampling=max_sampling,
+                                   step_size=step_size
+                )
+                
                 t = time.time()
                 logging.info(lib_utils.log_message("Calling RealSpaceCalibrator"))
                 self.sampling = calibrator(tdi.data)
@@ -114,6 +128,19 @@ class StructureRecognitionModule(AtomManipulatorModule):
             self.manipulator.t6 = threading.Thread(target = do_this, name = 'RealSpaceCalibrator')
             self.manipulator.t6.start()
 
+        def cache_calibration_changed(checked):
+            self.cache_calibration = checked
+
+        def calibration_revalidation_interval_changed(text):
+            if len(text) > 0:
+                try:
+                    self.calibration_revalidation_interval = max(0, int(text))
+                except:
+                    pass
+                finally:
+                    self.calibration_revalidation_interval_line_edit.text = \
+                        f"{self.calibration_revalidation_interval:d}"
+
         def image_source_changed(item):
             if type(item) == int:
                 item = self.image_source_combo_box.items[item]
@@ -139,6 +166,22 @@ class StructureRecognitionModule(AtomManipulatorModule):
         def auto_detect_foreign_atoms_changed(checked):
             self.auto_detect_foreign_atoms = checked
 
+        def inference_mode_changed(item):
+            if type(item) == int:
+                item = self.inference_mode_combo_box.items[item]
+            self.inference_mode_combo_box.current_item = item
+            self.inference_mode = self.inference_mode_combo_box.current_index
+            self.roi_frames = 0
+
+        def out_of_process_inference_changed(checked):
+            self.out_of_process_inference = checked
+            if not checked and self.inference_worker is not None:
+                self.inference_worker.close()
+                self.inference_worker = None
+
+        def prefetch_frames_changed(checked):
+            self.prefetch_frames = checked
+
         def element_id_int_radius_changed(text):
             if len(text) > 0:
                 try:
@@ -207,6 +250,16 @@ class StructureRecognitionModule(AtomManipulatorModule):
         scale_calibration_display_row.add(self.sampling_label)
         scale_calibration_display_row.add_stretch()
         
+        # Calibration cache rows.
+        cache_calibration_row, self.cache_calibration_check_box = \
+            check_box_template(self.ui, 'At run time: Cache calibration')
+        self.cache_calibration_check_box.on_checked_changed = cache_calibration_changed
+
+        calibration_revalidation_interval_row, self.calibration_revalidation_interval_line_edit = \
+            line_edit_template(self.ui, 'Re-validate every [frames]: ')
+        self.calibration_revalidation_interval_line_edit.on_editing_finished = \
+            calibration_revalidation_interval_changed
+
         # Field of view (FOV) row.
         fov_display_row = self.ui.create_row_widget()
         fov_display_row.add(self.ui.create_label_widget(_('FOV: ')))
@@ -228,6 +281,21 @@ class StructureRecognitionModule(AtomManipulatorModule):
             check_box_template(self.ui, 'Auto-detect foreign atoms')
         self.auto_detect_foreign_atoms_check_box.on_checked_changed = auto_detect_foreign_atoms_changed
 
+        # Inference mode row.
+        inference_mode_row, self.inference_mode_combo_box = combo_box_template(
+            self.ui, 'NN inference', ['Full frame', 'Tiled', 'ROI around foreign atoms and targets'])
+        self.inference_mode_combo_box.on_current_item_changed = inference_mode_changed
+
+        # Out-of-process inference row.
+        out_of_process_inference_row, self.out_of_process_inference_check_box = \
+            check_box_template(self.ui, 'Run NN in separate process')
+        self.out_of_process_inference_check_box.on_checked_changed = out_of_process_inference_changed
+
+        # Prefetch row.
+        prefetch_frames_row, self.prefetch_frames_check_box = \
+            check_box_template(self.ui, 'Live analysis: Prefetch next frame')
+        self.prefetch_frames_check_box.on_checked_changed = prefetch_frames_changed
+
         # Element identification rows.
         element_id_row1, self.element_id_int_radius_line_edit = \
             line_edit_template(self.ui, "Element ident.: Int. radius [A]: ")
@@ -248,6 +316,13 @@ class StructureRecognitionModule(AtomManipulatorModule):
         self.start_stop_analysis_button.state = None                    
         self.start_stop_analysis_button.on_clicked = start_stop_analysis
         
+        # Model state row.
+        model_state_row = self.ui.create_row_widget()
+        model_state_row.add(self.ui.create_label_widget(_('Model: ')))
+        self.model_state_label = self.ui.create_label_widget(lib_structure_recognition.model_state())
+        model_state_row.add(self.model_state_label)
+        model_state_row.add_stretch()
+
         # Number of atoms row.
         N_atoms_row = self.ui.create_row_widget()
         self.N_atoms_label = self.ui.create_label_widget('0')
@@ -260,22 +335,43 @@ class StructureRecognitionModule(AtomManipulatorModule):
         auto_detect_foreign_atoms_changed(self.auto_detect_foreign_atoms_check_box.checked)
         self.visualize_atoms_check_box.checked = defaults['visualize_atoms']
         visualize_atoms_changed(self.visualize_atoms_check_box.checked)
+        inference_mode_changed(defaults['inference_mode'])
+        self.out_of_process_inference_check_box.checked = defaults['out_of_process_inference']
+        out_of_process_inference_changed(self.out_of_process_inference_check_box.checked)
+        self.prefetch_frames_check_box.checked = defaults['prefetch_frames']
+        prefetch_frames_changed(self.prefetch_frames_check_box.checked)
         element_id_int_radius_changed(str(defaults['element_identification_integration_radius_A']))
         element_id_exponent_changed(str(defaults['element_identification_exponent']))
         image_source_changed(defaults['image_source'])
         scale_calibration_mode_changed(defaults['scale_calibration_mode'])
+        self.cache_calibration_check_box.checked = defaults['cache_calibration']
+        cache_calibration_changed(self.cache_calibration_check_box.checked)
+        calibration_revalidation_interval_changed(str(defaults['calibration_revalidation_interval']))
 
         # Assemble GUI elements.
         section1.column.add(scale_calibration_row)
+        section1.column.add(cache_calibration_row)
+        section1.column.add(calibration_revalidation_interval_row)
         section1.column.add(scale_calibration_display_row)
         section1.column.add(fov_display_row)
 
+        section2.column.add(model_state_row)
         section2.column.add(image_source_row)
         section2.column.add(visualize_atoms_row)
         section2.column.add(auto_detect_foreign_atoms_row)
         section2.column.add(element_id_row1)
         section2.column.add(element_id_row2)
+        section2.column.add(inference_mode_row)
+        section2.column.add(out_of_process_inference_row)
+        section2.column.add(prefetch_frames_row)
         section2.column.add_spacing(5)
         section2.column.add(live_analysis_row)
         section2.column.add(start_stop_analysis_row)
-        section2.column.add(N_atoms_row)
\ No newline at end of file
+        section2.column.add(N_atoms_row)
+
+        # Warm up the model in the background.
+        def model_loaded():
+            def func():
+                self.model_state_label.text = lib_structure_recognition.model_state()
+            self.api.queue_task(func)
+        lib_structure_recognition.load_model(callback=model_loaded)
@@ -9,7 +9,6 @@ from . import lib_structure_recognition
 from . import lib_pathfinding
 from .lib_utils import AtomManipulatorModule
 from .lib_widgets import Section, line_edit_template, check_box_template, combo_box_template
-from adf_feedback import adf_feedback as adffb
 
 _ = gettext.gettext
 
@@ -57,6 +56,7 @@ class TractorBeamModule(AtomManipulatorModule):
             logging.info(lib_utils.log_message("Starting TractorBeam"))
             try:
                 # In this (manual) operation mode, ADFFeedback needs to be stopped by direct call of the method stopmap.
+                from adf_feedback import adf_feedback as adffb # Imported on first use.
                 self.ADFFeedback = adffb.ADFFeedbackDelegate(
                     self.api,
                     offline_test_mode = self.otm_check_box.checked,
@@ -0,0 +1,162 @@
+"""
+Neural-network inference library.
+- Full frame: the model is called on the whole image.
+- Tiled: the model is called on overlapping tiles. Each tile contributes the points of its core region (the tile
+  without half of the overlap at inner borders). Points found twice at the seams are merged.
+- ROI: only a padded bounding box around given positions (foreign atoms and target sites) is inferred again.
+  The points of the previous frame are kept outside of the box.
+The output has the format of the model output restricted to per-point arrays ('points', 'labels', ...).
+Points are given as (x, y) in px of the full image.
+"""
+
+import numpy as np
+
+import logging
+
+from scipy.spatial import cKDTree
+
+# Custom libraries
+from . import lib_utils
+
+# Inference modes.
+FULL_FRAME = 0
+TILED = 1
+ROI = 2
+
+TILE_SIZE = 1024       # in px
+TILE_OVERLAP = 10.     # in Angstroem, should exceed the receptive field of the model at its borders
+ROI_PADDING = 15.      # in Angstroem, around the positions
+MERGE_DISTANCE = 0.7   # in Angstroem, points closer than this are duplicates (half of a C-C bond)
+ROI_FULL_FRAME_INTERVAL = 10 # Re-infer the full frame every {ROI_FULL_FRAME_INTERVAL} frames in ROI mode.
+
+
+# Main inference function.
+# model ... callable model(image, sampling)
+# sampling ... in Angstroem/px
+# mode ... FULL_FRAME, TILED, or ROI
+# positions ... (row, col) in px, ROI mode only
+# previous ... output of the previous frame, ROI mode only (falls back to TILED if None)
+def infer(model, image, sampling, mode=FULL_FRAME, positions=None, previous=None, tile_size=TILE_SIZE):
+    if mode == FULL_FRAME or (mode == TILED and max(image.shape) <= tile_size):
+        return model(image, sampling)
+    if mode == ROI and previous is not None and positions is not None and len(positions) > 0:
+        return infer_roi(model, image, sampling, positions, previous, tile_size=tile_size)
+    return infer_tiled(model, image, sampling, tile_size=tile_size)
+
+
+# Restricts the model output to per-point arrays.
+def _point_arrays(output):
+    if output is None:
+        return None
+    points = np.asarray(output['points'], dtype=float).reshape(-1, 2)
+    result = {'points': points}
+    for key, value in output.items():
+        if key != 'points' and isinstance(value, np.ndarray) and value.ndim > 0 and len(value) == len(points):
+            result[key] = value
+    return result
+
+
+# Concatenates per-point arrays.
+def _concatenate(outputs):
+    outputs = [x for x in outputs if x is not None]
+    if len(outputs) == 0:
+        return {'points': np.empty((0, 2)), 'labels': np.empty(0, dtype=int)}
+    keys = set.intersection(*[set(x) for x in outputs])
+    return {key: np.concatenate([x[key] for x in outputs]) for key in keys}
+
+
+# Selects points (boolean mask or indices).
+def _select(output, selection):
+    return {key: value[selection] for key, value in output.items()}
+
+
+# Tile origins along one axis, with tiles of size {size} overlapping by at least {overlap}.
+def _tile_starts(length, size, overlap):
+    if length <= size:
+        return [0]
+    step = max(1, size-overlap)
+    n = int(np.ceil((length-size)/step))+1
+    return list(np.round(np.linspace(0, length-size, n)).astype(int))
+
+
+# Core region (start, stop) of a tile along one axis: the tile without half of the overlap with its neighbors.
+def _cores(starts, size, length):
+    cores = []
+    for i, start in enumerate(starts):
+        lo = 0 if i == 0 else (starts[i-1]+size+start)/2
+        hi = length if i == len(starts)-1 else (start+size+starts[i+1])/2
+        cores.append((lo, hi))
+    return cores
+
+
+# Merges points closer than {distance} px, keeping the first of each group.
+def merge_duplicates(output, distance):
+    points = output['points']
+    if len(points) < 2:
+        return output
+    pairs = cKDTree(points).query_pairs(distance, output_type='ndarray')
+    if len(pairs) == 0:
+        return output
+    keep = np.ones(len(points), dtype=bool)
+    keep[np.maximum(pairs[:, 0], pairs[:, 1])] = False
+    return _select(output, keep)
+
+
+# Inference of the region [r0:r1, c0:c1] on overlapping tiles.
+# Returns the points with core positions in the region (borders of the region are kept).
+def infer_tiled(model, image, sampling, region=None, tile_size=TILE_SIZE):
+    r0, r1, c0, c1 = region if region is not None else (0, image.shape[0], 0, image.shape[1])
+    overlap = int(np.ceil(TILE_OVERLAP/sampling))
+    size = max(tile_size, 2*overlap+1)
+    row_starts = _tile_starts(r1-r0, size, overlap)
+    col_starts = _tile_starts(c1-c0, size, overlap)
+    row_cores = _cores(row_starts, size, r1-r0)
+    col_cores = _cores(col_starts, size, c1-c0)
+
+    outputs = []
+    for row_start, (row_lo, row_hi) in zip(row_starts, row_cores):
+        for col_start, (col_lo, col_hi) in zip(col_starts, col_cores):
+            y, x = r0+row_start, c0+col_start
+            tile = image[y:y+size, x:x+size]
+            output = _point_arrays(model(tile, sampling))
+            if output is None or len(output['points']) == 0:
+                continue
+            output['points'] = output['points'] + (x, y)
+            px, py = output['points'][:, 0]-c0, output['points'][:, 1]-r0
+            in_core = (py >= row_lo) & (py < row_hi) & (px >= col_lo) & (px < col_hi)
+            outputs.append(_select(output, in_core))
+
+    logging.info(lib_utils.log_message(f"Tiled inference on {len(row_starts)*len(col_starts):d} tiles."))
+    return merge_duplicates(_concatenate(outputs), MERGE_DISTANCE/sampling)
+
+
+# Re-inference of a padded bounding box around {positions}; the previous points are kept outside of the box.
+def infer_roi(model, image, sampling, positions, previous, tile_size=TILE_SIZE):
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    padding = ROI_PADDING/sampling
+    margin = TILE_OVERLAP/sampling/2 # Unreliable border of the inferred box, except at image borders.
+    shape = image.shape
+    r0 = int(max(0, np.floor(positions[:, 0].min()-padding-margin)))
+    r1 = int(min(shape[0], np.ceil(positions[:, 0].max()+padding+margin)+1))
+    c0 = int(max(0, np.floor(positions[:, 1].min()-padding-margin)))
+    c1 = int(min(shape[1], np.ceil(positions[:, 1].max()+padding+margin)+1))
+
+    if (r1-r0) <= tile_size and (c1-c0) <= tile_size:
+        output = _point_arrays(model(image[r0:r1, c0:c1], sampling))
+        if output is None:
+            output = _concatenate([])
+        output['points'] = output['points'] + (c0, r0)
+    else:
+        output = infer_tiled(model, image, sampling, region=(r0, r1, c0, c1), tile_size=tile_size)
+
+    # Core of the box: new points are taken inside, previous points outside.
+    lo = np.array([c0+margin if c0 > 0 else -np.inf, r0+margin if r0 > 0 else -np.inf])
+    hi = np.array([c1-margin if c1 < shape[1] else np.inf, r1-margin if r1 < shape[0] else np.inf])
+    def in_core(points):
+        return np.all((points >= lo) & (points < hi), axis=1)
+
+    previous = _point_arrays(previous)
+    output = _concatenate([_select(previous, ~in_core(previous['points'])),
+                           _select(output, in_core(output['points']))])
+    logging.info(lib_utils.log_message(f"ROI inference on {r1-r0:d} x {c1-c0:d} px."))
+    return merge_duplicates(output, MERGE_DISTANCE/sampling)
@@ -0,0 +1,137 @@
+"""
+Layered overlay compositing for the processed data item.
+- Frames are normalized to the base RGB frame (uint8) in preallocated buffers, which are reused as long as the frame
+  shape does not change.
+- The base RGB frame and the overlays (atoms, paths) are kept separately. An overlay layer is a set of pixels of
+  one color, layers are drawn in the order of their first use.
+- Two output buffers are used in turn, so that the buffer passed to Nion Swift is not modified while it is displayed.
+  A buffer is composed only after the previous one was set on the data item (see lib_utils.compose_overlay).
+- Changes are tracked as dirty tiles, separately for each buffer. Composing a buffer restores only its dirty tiles
+  from the base and redraws the layer pixels in them.
+- compose returns None if nothing changed since the last composed buffer (no update of the data item needed).
+- The frame is tagged with its number, so that a stage finishing late can tell that the overlay shows a newer frame.
+"""
+
+import threading
+import numpy as np
+
+TILE_SIZE = 64 # in px
+
+
+# Normalizes {data} (H x W) to 0..255 and writes it to the three channels of {out} (H x W x 3, uint8).
+# scratch ... float buffer (H x W) for the intermediate values, float32 for float32 data, float64 otherwise
+# gray ... uint8 buffer (H x W)
+def normalize_rgb(data, out, scratch, gray):
+    lo, hi = data.min(), data.max()
+    if hi == lo:
+        out[...] = 0
+        return out
+    np.subtract(data, lo, out=scratch, casting='unsafe')
+    np.divide(scratch, hi-lo, out=scratch)
+    np.multiply(scratch, 255, out=scratch)
+    np.copyto(gray, scratch, casting='unsafe') # Truncates, like astype.
+    # Channel by channel, much faster than broadcasting into the last axis.
+    for channel in range(out.shape[-1]):
+        out[..., channel] = gray
+    return out
+
+
+def scratch_dtype(dtype):
+    return dtype if dtype.kind == 'f' else np.dtype(np.float64)
+
+
+class OverlayCompositor(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.base = None
+        self.scratch = None
+        self.gray = None
+        self.tiles_shape = None
+        self.buffers = []
+        self.dirty = []      # Boolean tile masks, one per buffer.
+        self.layers = dict() # name -> (flat pixel indices, their tile indices, color)
+        self.front = 0       # Index of the buffer composed last.
+        self.changed = False # True if the layers changed since the last composed buffer.
+        self.frame_number = None # Number of the current frame (see lib_pipeline.FrameItem).
+
+    def set_frame(self, data, number=None):
+        # New frame (H x W), normalized into the base. Clears all layers, the next compose returns the plain frame.
+        # number ... frame number, layers of earlier frames are not drawn over this one (see frame_number)
+        with self.lock:
+            self.frame_number = number
+            shape = data.shape + (3,)
+            if self.base is None or self.base.shape != shape:
+                self.base = np.empty(shape, dtype=np.uint8)
+                self.buffers = [np.empty_like(self.base), np.empty_like(self.base)]
+                self.tiles_shape = (-(-shape[0] // TILE_SIZE), -(-shape[1] // TILE_SIZE))
+                self.dirty = [np.empty(self.tiles_shape, dtype=bool), np.empty(self.tiles_shape, dtype=bool)]
+                self.gray = np.empty(data.shape, dtype=np.uint8)
+            if self.scratch is None or self.scratch.shape != data.shape or \
+                    self.scratch.dtype != scratch_dtype(data.dtype):
+                self.scratch = np.empty(data.shape, dtype=scratch_dtype(data.dtype))
+            normalize_rgb(data, self.base, self.scratch, self.gray)
+            for dirty in self.dirty:
+                dirty[...] = True
+            self.layers = dict()
+            self.changed = True
+
+    def set_layer(self, name, rows, cols, color):
+        # Replaces the pixels of a layer. Pixels outside of the frame are clipped.
+        with self.lock:
+            if self.base is None:
+                return
+            shape = self.base.shape
+            in_image = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+            flat = np.unique(rows[in_image]*shape[1] + cols[in_image])
+            old = self.layers.get(name)
+            if old is not None and old[2] == tuple(color) and np.array_equal(old[0], flat):
+                return
+            pixel_tiles = self._tiles(flat)
+            self.layers[name] = (flat, pixel_tiles, tuple(color))
+
+            tiles = np.unique(pixel_tiles)
+            if old is not None:
+                tiles = np.union1d(tiles, old[1])
+            for dirty in self.dirty:
+                dirty.ravel()[tiles] = True
+            self.changed = True
+
+    def clear_layer(self, name):
+        self.set_layer(name, np.empty(0, dtype=int), np.empty(0, dtype=int), (0, 0, 0))
+
+    def compose(self):
+        # Returns the buffer with the current layers, or None if nothing changed since the last call.
+        with self.lock:
+            if self.base is None or not self.changed:
+                return None
+            back = 1 - self.front
+            buffer = self.buffers[back]
+            dirty = self.dirty[back]
+
+            if dirty.all():
+                np.copyto(buffer, self.base)
+            else:
+                # Restore the dirty tiles, in runs of consecutive tiles per row of tiles.
+                for i in np.nonzero(dirty.any(axis=1))[0]:
+                    row = np.concatenate(([False], dirty[i], [False]))
+                    edges = np.nonzero(np.diff(row.astype(np.int8)))[0]
+                    r = slice(i*TILE_SIZE, (i+1)*TILE_SIZE)
+                    for j0, j1 in zip(edges[::2], edges[1::2]):
+                        c = slice(j0*TILE_SIZE, j1*TILE_SIZE)
+                        buffer[r, c] = self.base[r, c]
+
+            # Redraw the layer pixels in the dirty tiles.
+            flat_buffer = buffer.reshape(-1, buffer.shape[-1])
+            for flat, pixel_tiles, color in self.layers.values():
+                flat_buffer[flat[dirty.ravel()[pixel_tiles]]] = color
+
+            dirty[...] = False
+            self.front = back
+            self.changed = False
+            return buffer
+
+    def _tiles(self, flat):
+        # Tile indices of flat pixel indices.
+        width = self.base.shape[1]
+        return (flat // width // TILE_SIZE) * self.tiles_shape[1] + (flat % width) // TILE_SIZE
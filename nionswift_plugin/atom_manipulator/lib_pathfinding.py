@@ -10,7 +10,6 @@ import gettext
 import threading
 import numpy as np
 
-import copy
 import time
 import logging
 
@@ -18,16 +17,17 @@ import logging
 from nion.utils import Geometry
 
 # Custom libraries
-from .classes import atoms_and_bonds as aab, paths
+from .classes import atoms_and_bonds as aab, paths, path_pool
 from . import lib_utils
+from . import lib_pipeline
 
 _ = gettext.gettext
 
 
-# Main pathfinding function.
-def find_paths(manipulator, auto_manipulate=False):
+# Main pathfinding function (single run on the current frame).
+def find_paths(manipulator):
 
-    if (manipulator.sites == []) and not auto_manipulate:
+    if manipulator.sites == []:
             logging.info(lib_utils.log_message("No sites found. Pathfinder aborted."))
             return
     if manipulator.t5 is not None and manipulator.t5.is_alive():
@@ -35,73 +35,141 @@ def find_paths(manipulator, auto_manipulate=False):
             return 
     
     def do_this():
-        stop = False
-        while not stop and not (auto_manipulate and manipulator.manipulation_module.stop_auto_manipulate_event.is_set()):
-            if auto_manipulate:
-                if not manipulator.structure_recognition_module.rdy.wait(0.1):
-                    continue
-                else:
-                    manipulator.structure_recognition_module.rdy.clear()
-            else:
-                stop = True
-
-            # Aliases.
-            pdi = manipulator.processed_data_item
-            
-            # Set bonds.
-            t = time.time()
-
-            logging.info(lib_utils.log_message("Setting bonds..."))
-            max_bond_length_px = manipulator.source_xdata.dimensional_calibrations[0].convert_from_calibrated_size(
-                    manipulator.pathfinding_module.max_bond_length/10)
-            if manipulator.simulation_mode: # Fix for wrong conversion in nionswift-usim fork
-                max_bond_length_px *= 1 # Conversion in usim fork had been fixed
-            manipulator.bonds = aab.Bonds(manipulator.sites, max_bond_length_px)
-            
-            t = time.time()-t
-            logging.info(lib_utils.log_message(f"Setting bonds finished after {t:.5f} seconds"))
-            
-            # Call pathfinder.
-            t = time.time()
-
-            logging.info(lib_utils.log_message("Pathfinder called."))
-            try:
-                manipulator.paths = paths.Paths(manipulator.sources, manipulator.targets)
-            except ValueError as e:
-                print(e)
-                return
+        sources, targets = frame_sources_and_targets(manipulator)
+        item = lib_pipeline.FrameItem(number=manipulator.overlay.frame_number, xdata=manipulator.source_xdata,
+                                      scan_parameters_changed=manipulator.scan_parameters_changed,
+                                      metadata=manipulator.metadata_to_append, sites=manipulator.sites,
+                                      sources=sources, targets=targets)
+        item = set_bonds(manipulator, item)
+        plan_paths(manipulator, item)
+        
+    manipulator.t5 = threading.Thread(target = do_this)
+    manipulator.t5.start()
+
+
+# Foreign atoms (copies) and target sites on the current sites, for a per-frame work item (see lib_pipeline).
+# Atoms and targets that could not be reattached to the current sites are left out.
+def frame_sources_and_targets(manipulator):
+    lattice = manipulator.sites[0].lattice if len(manipulator.sites) > 0 else None
+    sources = tuple(aab.Atom(x.origin, x.element, defined_by_user=x.defined_by_user)
+                    for x in manipulator.sources if x.origin.lattice is lattice)
+    targets = tuple(x for x in manipulator.targets if x.lattice is lattice)
+    return sources, targets
+
+
+# Pathfinding stages of the pipeline (see lib_pipeline), following structure recognition.
+# drop ... if True, frames arriving while pathfinding is still working are skipped
+def pipeline_stages(manipulator, auto_manipulate=False, drop=False):
+    stages = [lib_pipeline.Stage('Bonds', lambda item: set_bonds(manipulator, item), drop=drop),
+              lib_pipeline.Stage('Pathfinding', lambda item: plan_paths(manipulator, item, auto_manipulate))]
+    if auto_manipulate:
+        stages.append(lib_pipeline.Stage('Probe', lambda item: probe(manipulator, item)))
+    return stages
+
+
+# Pipeline stage: set bonds between the sites of the frame.
+def set_bonds(manipulator, item):
+    t = time.time()
+
+    logging.info(lib_utils.log_message("Setting bonds..."))
+    max_bond_length_px = item.xdata.dimensional_calibrations[0].convert_from_calibrated_size(
+            manipulator.pathfinding_module.max_bond_length/10)
+    if manipulator.simulation_mode: # Fix for wrong conversion in nionswift-usim fork
+        max_bond_length_px *= 1 # Conversion in usim fork had been fixed
+    bonds = manipulator.bonds
+    incremental = manipulator.pathfinding_module.incremental_bonds
+    if incremental and bonds is not None and bonds.incremental and \
+            bonds.max_bond_length == max_bond_length_px and not item.scan_parameters_changed:
+        # Consecutive frame: search bond candidates only near changed sites (same bonds as a rebuild).
+        N_recomputed = bonds.update(item.sites)
+    else:
+        manipulator.bonds = aab.Bonds(item.sites, max_bond_length_px, incremental=incremental)
+        N_recomputed = len(item.sites)
+    
+    t = time.time()-t
+    logging.info(lib_utils.log_message(f"Setting bonds finished after {t:.5f} seconds "
+                                       f"({N_recomputed:d} of {len(item.sites):d} sites recomputed)"))
+    return item._replace(bonds=manipulator.bonds)
+
+
+# Pipeline stage: determine and plot the paths from the foreign atoms to the target sites.
+def plan_paths(manipulator, item, auto_manipulate=False):
+    t = time.time()
+
+    logging.info(lib_utils.log_message("Pathfinder called."))
+    if manipulator.plan_cache is None:
+        manipulator.plan_cache = paths.PlanCache()
+    cost_metric = 'hops' if manipulator.pathfinding_module.hop_distance_costs else 'euclidean'
+    assignment_cutoff = manipulator.pathfinding_module.assignment_cutoff # in Angstroem
+    if assignment_cutoff is not None:
+        assignment_cutoff = item.xdata.dimensional_calibrations[0].convert_from_calibrated_size(assignment_cutoff/10)
+    planner = manipulator.pathfinding_module.planner
+    # Only the foreign atoms and target sites of the frame are used (see frame_sources_and_targets).
+    sources, targets = list(item.sources), list(item.targets)
+    key = manipulator.plan_cache.fingerprint(sources, targets, avoid_1nn=True,
+                                             avoid_2nn=True, cost_metric=cost_metric, planner=planner,
+                                             assignment_cutoff=assignment_cutoff)
+    cached_paths = manipulator.plan_cache.get(key, sources, targets)
+    if cached_paths is not None:
+        # Unchanged lattice and inputs: reuse the planned paths.
+        manipulator.paths = cached_paths
+        logging.info(lib_utils.log_message("Paths reused from plan cache."))
+    else:
+        try:
+            manipulator.paths = paths.Paths(sources, targets,
+                                            assignment_cutoff=assignment_cutoff, cost_metric=cost_metric)
+        except ValueError as e:
+            print(e)
+            return None
+        else:
+            if planner == 1:
+                manipulator.paths.determine_paths_prioritized(avoid_1nn=True, avoid_2nn=True)
             else:
-                manipulator.paths.determine_paths_no_collision(avoid_1nn=True, avoid_2nn=True)
-            
-            # Plot paths.
-            while not manipulator.rdy_init_pdi.wait(1) or not manipulator.rdy_update_pdi.wait(1):
-                pass
+                pool = None
+                if manipulator.pathfinding_module.parallel_direct_paths:
+                    if manipulator.path_pool is None: # Persistent, started on first use.
+                        manipulator.path_pool = path_pool.PathPool()
+                    pool = manipulator.path_pool
+                manipulator.paths.determine_paths_no_collision(avoid_1nn=True, avoid_2nn=True, pool=pool)
+            manipulator.plan_cache.put(key, manipulator.paths, sources, targets)
+    
+    # Plot paths.
+    manipulator.rdy_init_pdi.wait()
+    manipulator.rdy_update_pdi.wait()
 
-            tmp_image = copy.copy(pdi.data)
-            lib_utils.plot_paths(tmp_image, manipulator.paths)
+    # Append timestamp to metadata.
+    metadata = dict(item.metadata, timestamp_3_pathfinding_finished=time.time())
 
-            # Append timestamp to metadata.
-            manipulator.metadata_to_append['timestamp_3_pathfinding_finished'] = time.time()
+    with manipulator.compose_lock:
+        # The paths and metadata of this frame are not shown over a newer frame.
+        if manipulator.overlay.frame_number != item.number:
+            logging.info(lib_utils.log_message(f"Paths of frame {item.number} not shown, "
+                                               f"frame {manipulator.overlay.frame_number} is shown already."))
+        else:
+            manipulator.overlay.set_layer('paths', *lib_utils.paths_pixels(manipulator.paths),
+                                          lib_utils.PATHS_COLOR)
+            manipulator.metadata_to_append = metadata
 
             # Update data item.
-            manipulator.rdy_update_pdi.clear()
-            lib_utils.update_pdi(manipulator, tmp_image)
-    
-            t_end = time.time()
-            logging.info(lib_utils.log_message(f"Pathfinder finished after {t_end-t:.5f} seconds"))
-            
-            # Move probe if in "Auto Manipulation" operation mode.
-            if auto_manipulate:
-                move_probe(manipulator)
-
-            # Trigger ready-event.
-            manipulator.pathfinding_module.rdy.set()
-
-        if auto_manipulate:
-            logging.info(lib_utils.log_message("Pathfinder stopped."))
-        
-    manipulator.t5 = threading.Thread(target = do_this)
-    manipulator.t5.start()
+            lib_utils.update_pdi(manipulator, lib_utils.compose_overlay(manipulator))
+
+    t_end = time.time()
+    logging.info(lib_utils.log_message(f"Pathfinder finished after {t_end-t:.5f} seconds"))
+
+    # Trigger ready-event (in "Auto Manipulation" operation mode after the probe has been moved).
+    if not auto_manipulate:
+        manipulator.pathfinding_module.rdy.set()
+
+    return item._replace(metadata=metadata, paths=manipulator.paths)
+
+
+# Pipeline stage: move the probe along the paths ("Auto Manipulation" operation mode).
+def probe(manipulator, item):
+    move_probe(manipulator)
+
+    # Trigger ready-event.
+    manipulator.pathfinding_module.rdy.set()
+    return item
 
 
 # Wrapper for adding/removing foreign atoms / target sites
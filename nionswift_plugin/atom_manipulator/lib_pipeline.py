@@ -0,0 +1,146 @@
+"""
+Staged processing pipeline.
+- A source (acquisition) feeds per-frame work items into a chain of stages, e.g.
+  acquisition -> calibration -> structure recognition (NN) -> bonds -> paths -> probe move.
+- Each stage runs in its own thread. Consecutive stages are connected by bounded queues.
+- Work items are immutable (see FrameItem). A stage returns an updated copy or None to drop the item.
+- Backpressure: a stage blocks while its downstream queue is full, or drops the item if the queue is configured so.
+  With the latest-frame-wins policy, a queued item that has not been started yet is replaced by the newer one.
+"""
+
+import threading
+import queue
+import logging
+from collections import namedtuple
+
+# Custom libraries
+from . import lib_utils
+
+
+# Per-frame work item.
+# number ... frame number within the run
+# xdata, title ... source data and title
+# scan_parameters_changed ... True if the scan parameters differ from the previous frame
+# metadata ... dict of metadata to append to the processed data item (replaced, never modified)
+# sampling ... in Angstroem/px
+# sites, bonds, paths ... back-end objects of the frame
+# sources, targets ... foreign atoms (copies of class "Atom") and target sites on the sites of the frame (tuples)
+FrameItem = namedtuple('FrameItem', ['number', 'xdata', 'title', 'scan_parameters_changed', 'metadata',
+                                     'sampling', 'sites', 'bonds', 'paths', 'sources', 'targets'],
+                       defaults=(None,)*11)
+
+# End of stream, passed through all queues.
+_STOP = object()
+
+
+class Stage(object):
+    # name ... for logging
+    # func ... function of a work item, returns the work item for the next stage or None
+    # maxsize ... capacity of the queue in front of the stage
+    # drop ... if True, items are dropped instead of blocking the upstream stage when the queue is full
+    # latest ... if True, the oldest queued item is dropped instead (latest-frame-wins)
+
+    def __init__(self, name, func, maxsize=1, drop=False, latest=False):
+        self.name = name
+        self.func = func
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.drop = drop
+        self.latest = latest
+        self.thread = None
+
+
+class Pipeline(object):
+    # source ... generator function of the pipeline yielding work items; it should end once pipeline.stopped is True
+    # stages ... list of class members of "Stage"
+    # wake_events ... threading.Event objects the source may be waiting for, set on stop to wake it up
+    #
+    # A pipeline can be used in place of a thread (start, is_alive, join).
+
+    def __init__(self, source, stages, wake_events=(), name='pipeline'):
+        self.source = source
+        self.stages = list(stages)
+        self.wake_events = list(wake_events)
+        self.name = name
+        self.stop_event = threading.Event()
+        self.source_thread = None
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def start(self):
+        self.stop_event.clear()
+        for i, stage in enumerate(self.stages):
+            downstream = self.stages[i+1] if i+1 < len(self.stages) else None
+            stage.thread = threading.Thread(target=self._run_stage, args=(stage, downstream),
+                                            name=f"{self.name}: {stage.name}")
+            stage.thread.start()
+        self.source_thread = threading.Thread(target=self._run_source, name=f"{self.name}: source")
+        self.source_thread.start()
+
+    def stop(self):
+        # Ends the pipeline after the items in process.
+        self.stop_event.set()
+        for event in self.wake_events:
+            event.set()
+
+    def is_alive(self):
+        threads = [self.source_thread] + [stage.thread for stage in self.stages]
+        return any(thread is not None and thread.is_alive() for thread in threads)
+
+    def join(self, timeout=None):
+        for thread in [self.source_thread] + [stage.thread for stage in self.stages]:
+            if thread is not None:
+                thread.join(timeout)
+
+    def _put(self, stage, item):
+        if stage is None:
+            return
+        if stage.drop and item is not _STOP:
+            try:
+                stage.queue.put_nowait(item)
+            except queue.Full:
+                logging.info(lib_utils.log_message(f"{stage.name} busy. Frame {item.number} skipped."))
+        elif stage.latest and item is not _STOP:
+            while True:
+                try:
+                    stage.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+                try:
+                    stale = stage.queue.get_nowait()
+                except queue.Empty:
+                    continue # Taken by the stage in the meantime.
+                logging.info(lib_utils.log_message(f"{stage.name} busy. Frame {stale.number} replaced by "
+                                                   f"frame {item.number}."))
+        else:
+            stage.queue.put(item)
+
+    def _run_source(self):
+        first = self.stages[0] if self.stages else None
+        try:
+            for item in self.source(self):
+                self._put(first, item)
+        except Exception:
+            logging.exception(lib_utils.log_message(f"Exception in {self.name}: source"))
+            self.stop()
+        finally:
+            self._put(first, _STOP)
+
+    def _run_stage(self, stage, downstream):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                self._put(downstream, _STOP)
+                return
+            if self.stopped:
+                continue # Drain.
+            try:
+                item = stage.func(item)
+            except Exception:
+                logging.exception(lib_utils.log_message(f"Exception in {self.name}: {stage.name}"))
+                self.stop()
+                continue
+            if item is not None:
+                self._put(downstream, item)
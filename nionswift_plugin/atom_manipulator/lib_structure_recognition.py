@@ -18,18 +18,86 @@ import logging
 
 import math
 
-# Non-standard packages
-from fourier_scale_calibration.fourier_scale_calibration import FourierSpaceCalibrator
+# Non-standard packages (fourier_scale_calibration, nionswift_structure_recognition) are imported on first use.
 
 # Custom libraries
-from .classes import atoms_and_bonds as aab
+from .classes import atoms_and_bonds as aab, calibration_cache, inference_worker
 from . import lib_utils
 from . import lib_pathfinding 
+from . import lib_pipeline
+from . import lib_inference
 
 _ = gettext.gettext
+
+# Maximum displacement of an atom between consecutive frames to keep its site ID (in Angstroem).
+MAX_SITE_DISPLACEMENT = 0.7
+
+# Preset model shared by all panels, loaded once (see load_model).
+MODEL_PRESET = 'graphene'
+_model = None
+_model_error = None
+_model_loaded = threading.Event()
+_model_lock = threading.Lock()
+_model_thread = None
+_model_callbacks = []
+
+
+# Starts loading the shared model in a background thread, if not done before.
+# callback ... called without arguments when the model has been loaded (or failed to load)
+def load_model(callback=None):
+    global _model_thread
+    with _model_lock:
+        if callback is not None:
+            if _model_loaded.is_set():
+                callback()
+            else:
+                _model_callbacks.append(callback)
+        if _model_thread is not None:
+            return
+
+        def do_this():
+            global _model, _model_error
+            t = time.time()
+            logging.info(lib_utils.log_message("Loading neural network model ..."))
+            try:
+                from nionswift_plugin.nionswift_structure_recognition.model import load_preset_model
+                _model = load_preset_model(MODEL_PRESET)
+            except Exception as e:
+                _model_error = e
+                logging.info(lib_utils.log_message(f"Loading neural network model failed: {e}"))
+            else:
+                t = time.time()-t
+                logging.info(lib_utils.log_message(f"Neural network model loaded after {t:.5f} seconds."))
+            with _model_lock:
+                _model_loaded.set()
+                callbacks = list(_model_callbacks)
+                _model_callbacks.clear()
+            for f in callbacks:
+                f()
+
+        _model_thread = threading.Thread(target=do_this, name='ModelLoader', daemon=True)
+        _model_thread.start()
+
+
+# Returns the shared model, waits until it has been loaded. Raises the error if loading failed.
+def shared_model():
+    load_model()
+    _model_loaded.wait()
+    if _model is None:
+        raise RuntimeError(f"Neural network model not available: {_model_error}")
+    return _model
+
+
+# Model state for display: 'Loading ...', 'Ready', or 'Not available'.
+def model_state():
+    if not _model_loaded.is_set():
+        return 'Loading ...'
+    return 'Ready' if _model is not None else 'Not available'
    
 
 # Main structure recognition function.
+# Runs a pipeline (see lib_pipeline): acquisition -> calibration -> structure recognition, followed by
+# bonds -> paths in live analysis and by bonds -> paths -> probe move in automated manipulation.
 def analyze_and_show(structure_recognition_module, auto_manipulate=False, live_analysis=False):
     if structure_recognition_module.manipulator.t1 is not None and structure_recognition_module.manipulator.t1.is_alive():
             logging.info(lib_utils.log_message("Structure recognition still working, wait until finished."))
@@ -51,230 +119,336 @@ def analyze_and_show(structure_recognition_module, auto_manipulate=False, live_a
         manipulator.rdy_create_pdi.clear()
         lib_utils.create_pdi(manipulator)
 
-    def do_this():
-        while not (not auto_manipulate and structure_recognition_module.stop_live_analysis_event.is_set()) \
-              and \
+    def source(pipeline):
+        number = 0
+        while not pipeline.stopped and \
+              not (not auto_manipulate and structure_recognition_module.stop_live_analysis_event.is_set()) and \
               not (auto_manipulate and manipulator.manipulation_module.stop_auto_manipulate_event.is_set()):
-                  
-                if not live_analysis:
-                    structure_recognition_module.stop_live_analysis_event.set()
 
-                wait_time = 2
-                if manipulator.rdy_create_pdi.wait(wait_time): # Wait for a maximum of {wait_time} seconds.
-                    pass
-                else:
-                    logging.info(lib_utils.log_message("Waiting for UI thread for more than {wait_time} seconds."
-                                                       "Possible code performance issue or a crashed thread."))
+            if not live_analysis:
+                structure_recognition_module.stop_live_analysis_event.set()
 
-                if auto_manipulate:
-                    if not manipulator.tractor_beam_module.rdy.wait(0.1):
-                        #print("waiting for tb module")
-                        continue
-                manipulator.tractor_beam_module.rdy.clear()
-
-                # Initiliaze or clear metadata to append
-                manipulator.metadata_to_append = dict()
-                
-                if "SELEC" in imgsrc:
-                    structure_recognition_module.stop_live_analysis_event.set()
-                    tdi = manipulator.document_controller.target_data_item
-                    manipulator.source_xdata = tdi.xdata
-                    manipulator.source_title = tdi.title
-                    manipulator.metadata_to_append['was_live_feed'] = False
-                    manipulator.metadata_to_append['timestamp_1_data_feed'] = time.time()
-                    manipulator.scan_parameters_changed = True
-                else:
-                    logging.info(lib_utils.log_message("Grabbing next STEM image ..."))
-                    if (not manipulator.superscan.is_playing and not live_analysis) or auto_manipulate:
-                        # Start and stop scanning when these conditions are met.
-                        manipulator.superscan.start_playing()
-                        time.sleep(0.05) # Small delay is necessary due to a delayed response of the Nion Swift code.
-                        manipulator.superscan.stop_playing()
-                        
-                    last_record = manipulator.superscan.grab_next_to_finish()
-                    manipulator.metadata_to_append['was_live_feed'] = True
-                    manipulator.metadata_to_append['timestamp_1_data_feed'] = time.time()
-                    for item in last_record:
-                        if imgsrc == "FIRST" or item.metadata['hardware_source']['channel_name'] == imgsrc:
-                            scan_parameters = manipulator.superscan.get_frame_parameters()
-                            scan_parameters = np.array((scan_parameters['fov_nm'], 'placeholder'))
-                            if manipulator.scan_parameters is None:
-                                manipulator.scan_parameters = scan_parameters
-                            if all(scan_parameters==manipulator.scan_parameters):
-                                manipulator.scan_parameters_changed = False
-                            else:
-                                manipulator.scan_parameters_changed = True
-                                manipulator.scan_parameters = scan_parameters
-                            manipulator.source_xdata = item
-                            manipulator.source_title = \
-                                item.metadata['hardware_source']['hardware_source_name'] + \
-                                ' (' + imgsrc + ")"
-                            break
-                        
-                if auto_manipulate:
-                    structure_recognition_module.new_image.set() # For TractorBeam module.
-                    
-                # Aliases.
-                pdi = manipulator.processed_data_item
-                shape = np.array(manipulator.source_xdata.data_shape)
-
-                if manipulator.source_xdata is None:
-                    logging.info(lib_utils.log_message("No source data."))
-                    structure_recognition_module.stop_live_analysis_event.set()
+            if auto_manipulate:
+                # Set by the TractorBeam module when it is done. Timed wait, so that a stop is not missed.
+                while not manipulator.tractor_beam_module.rdy.wait(0.1):
+                    if pipeline.stopped or manipulator.manipulation_module.stop_auto_manipulate_event.is_set():
+                        break
+                if pipeline.stopped or manipulator.manipulation_module.stop_auto_manipulate_event.is_set():
                     break
-                
-                # Calibrates the image scale based on a Fourier transform of the lattice.
-                if structure_recognition_module.scale_calibration_mode == 1:
-                    t = time.time()
-                    logging.info(lib_utils.log_message("FourierSpaceCalibrator called."))
-                
-                    calibrator = FourierSpaceCalibrator('hexagonal', 2.46)
-                    structure_recognition_module.sampling = calibrator(manipulator.source_xdata.data)
-                    structure_recognition_module.fov = [structure_recognition_module.sampling*s
-                                                        for s in manipulator.source_xdata.data.shape]
-                
-                    t = time.time()-t
-                    logging.info(lib_utils.log_message(f"FourierSpaceCalibrator finished after {t:.5f} seconds."))
-                else:
-                    # structure_recognition_module.sampling must have been written before.
-                    if structure_recognition_module.sampling is None:
-                        logging.info(lib_utils.log_message("Saved value for 'sampling' is None. Stopping..."))
-                        return None # Stop manipulator.
-
-                # Call fully convolutional neural network (FCNN).
-                t = time.time()
-                logging.info(lib_utils.log_message("Neural network called for structure recognition."))
-                
-                structure_recognition_module.nn_output = \
-                    structure_recognition_module.model(manipulator.source_xdata.data, structure_recognition_module.sampling)
+            manipulator.tractor_beam_module.rdy.clear()
 
-                t = time.time()-t
-                logging.info(lib_utils.log_message(f"Neural network returned result after {t:.5f} seconds."))
+            number += 1
+            item = acquire(structure_recognition_module, imgsrc, number, auto_manipulate, live_analysis)
+            if item is None:
+                break
+            structure_recognition_module.rdy.clear()
+            yield item
+
+            if live_analysis and not prefetch:
+                # Acquire the next frame only after the current one has been analyzed.
+                while not structure_recognition_module.rdy.wait(0.1):
+                    if pipeline.stopped or structure_recognition_module.stop_live_analysis_event.is_set():
+                        break
 
-                manipulator.rdy_init_pdi.clear()
-                lib_utils.init_pdi(manipulator) # Done here to give the user a possibility to look at the paths.
+        if auto_manipulate:
+            logging.info(lib_utils.log_message("Structure recognition stopped."))
 
-                # Conditioning NN output.
-                if structure_recognition_module.nn_output is not None:
-                    manipulator.maxima_locations = np.fliplr(structure_recognition_module.nn_output['points'])
-                    number_maxima = len(manipulator.maxima_locations)
+    # Double-buffered acquisition in live analysis: the next frame is grabbed while the current one is analyzed.
+    # A grabbed frame waiting for analysis is replaced by a newer one (latest-frame-wins).
+    prefetch = live_analysis and structure_recognition_module.prefetch_frames
+    stages = [lib_pipeline.Stage('Calibration', lambda item: calibrate(structure_recognition_module, item),
+                                 latest=prefetch),
+              lib_pipeline.Stage('Structure recognition', lambda item: recognize(structure_recognition_module, item),
+                                 latest=prefetch)]
+    if auto_manipulate:
+        stages += lib_pathfinding.pipeline_stages(manipulator, auto_manipulate=True)
+    elif live_analysis: # Pathfinding is skipped for frames arriving while it is still working.
+        stages += lib_pathfinding.pipeline_stages(manipulator, drop=True)
+
+    # Run in other threads.
+    manipulator.t1 = lib_pipeline.Pipeline(source, stages, wake_events=[manipulator.tractor_beam_module.rdy,
+                                                                         structure_recognition_module.rdy],
+                                           name='AtomManipulator')
+    manipulator.t1.start()
+
+
+# Pipeline stage: grab the next frame. Returns the work item or None if there is no source data.
+def acquire(structure_recognition_module, imgsrc, number, auto_manipulate=False, live_analysis=False):
+    manipulator = structure_recognition_module.manipulator
+
+    wait_time = 2
+    if not manipulator.rdy_create_pdi.wait(wait_time): # Wait for a maximum of {wait_time} seconds.
+        logging.info(lib_utils.log_message(f"Waiting for UI thread for more than {wait_time} seconds."
+                                           "Possible code performance issue or a crashed thread."))
+        manipulator.rdy_create_pdi.wait()
+
+    # Initiliaze metadata to append
+    metadata = dict()
+    xdata = None
+    title = None
+    scan_parameters_changed = True
+
+    if "SELEC" in imgsrc:
+        structure_recognition_module.stop_live_analysis_event.set()
+        tdi = manipulator.document_controller.target_data_item
+        xdata = tdi.xdata
+        title = tdi.title
+        metadata['was_live_feed'] = False
+        metadata['timestamp_1_data_feed'] = time.time()
+    else:
+        logging.info(lib_utils.log_message("Grabbing next STEM image ..."))
+        if (not manipulator.superscan.is_playing and not live_analysis) or auto_manipulate:
+            # Start and stop scanning when these conditions are met.
+            manipulator.superscan.start_playing()
+            time.sleep(0.05) # Small delay is necessary due to a delayed response of the Nion Swift code.
+            manipulator.superscan.stop_playing()
+            
+        last_record = manipulator.superscan.grab_next_to_finish()
+        metadata['was_live_feed'] = True
+        metadata['timestamp_1_data_feed'] = time.time()
+        for record in last_record:
+            if imgsrc == "FIRST" or record.metadata['hardware_source']['channel_name'] == imgsrc:
+                scan_parameters = manipulator.superscan.get_frame_parameters()
+                scan_parameters = np.array((scan_parameters['fov_nm'], 'placeholder'))
+                if manipulator.scan_parameters is None:
+                    manipulator.scan_parameters = scan_parameters
+                if all(scan_parameters==manipulator.scan_parameters):
+                    scan_parameters_changed = False
                 else:
-                    manipulator.maxima_locations = None
-                    number_maxima = 0
-                    
-                logging.info(lib_utils.log_message(f"{number_maxima:d} atoms were found."))
-                
-                # Call object-oriented backend to draw atom positions and bonds.
-                t = time.time()
-                manipulator.sites = []
-                manipulator.paths = []
-                for i in range(number_maxima):
-                    loc = manipulator.maxima_locations[i]
-                    manipulator.sites.append( aab.Site(
-                        loc[0], loc[1], site_id=i) )
-                        
-                lib_utils.refresh_GUI(manipulator, ['atoms', 'sampling'])
+                    scan_parameters_changed = True
+                    manipulator.scan_parameters = scan_parameters
+                xdata = record
+                title = record.metadata['hardware_source']['hardware_source_name'] + ' (' + imgsrc + ")"
+                break
+            
+    if auto_manipulate:
+        structure_recognition_module.new_image.set() # For TractorBeam module.
 
-                t = time.time()-t
-                logging.info(lib_utils.log_message(f"Setting sites (back end) finished after {t:.5f} seconds."))
+    if xdata is None:
+        logging.info(lib_utils.log_message("No source data."))
+        structure_recognition_module.stop_live_analysis_event.set()
+        return None
+
+    return lib_pipeline.FrameItem(number=number, xdata=xdata, title=title,
+                                  scan_parameters_changed=scan_parameters_changed, metadata=metadata)
+
+
+# Pipeline stage: calibrate the image scale. Returns the work item with the sampling or None to stop.
+# The sampling is only passed on with the work item, later stages may still work on previous frames.
+def calibrate(structure_recognition_module, item):
+    # Calibrates the image scale based on a Fourier transform of the lattice.
+    if structure_recognition_module.scale_calibration_mode == 1:
+        # Reuse the sampling of frames with the same field of view, frame size, and channel.
+        key = None
+        sampling = None
+        if structure_recognition_module.cache_calibration:
+            if structure_recognition_module.calibration_cache is None:
+                structure_recognition_module.calibration_cache = calibration_cache.CalibrationCache()
+            cache = structure_recognition_module.calibration_cache
+            cache.revalidate_every = structure_recognition_module.calibration_revalidation_interval
+            metadata = item.xdata.metadata
+            key = calibration_cache.CalibrationCache.key(metadata.get('scan', {}).get('fov_nm'),
+                                                         item.xdata.data_shape,
+                                                         metadata.get('hardware_source', {}).get('channel_name'))
+            sampling = cache.get(key)
+
+        if sampling is not None:
+            logging.info(lib_utils.log_message(f"Sampling reused from calibration cache ({sampling:.5f} A/px)."))
+        else:
+            t = time.time()
+            logging.info(lib_utils.log_message("FourierSpaceCalibrator called."))
+        
+            from fourier_scale_calibration.fourier_scale_calibration import FourierSpaceCalibrator
+            calibrator = FourierSpaceCalibrator('hexagonal', 2.46)
+            sampling = calibrator(item.xdata.data)
+        
+            t = time.time()-t
+            logging.info(lib_utils.log_message(f"FourierSpaceCalibrator finished after {t:.5f} seconds."))
+
+            if key is not None and cache.put(key, sampling):
+                logging.info(lib_utils.log_message("Calibration drift detected, cached sampling updated."))
+    else:
+        # structure_recognition_module.sampling must have been written before.
+        sampling = structure_recognition_module.sampling
+        if sampling is None:
+            logging.info(lib_utils.log_message("Saved value for 'sampling' is None. Stopping..."))
+            structure_recognition_module.manipulator.t1.stop() # Stop manipulator.
+            return None
+
+    return item._replace(sampling=sampling)
+
+
+# Returns the model, or the worker process running the model if inference out of process is enabled.
+def get_model(structure_recognition_module):
+    if structure_recognition_module.out_of_process_inference:
+        if structure_recognition_module.inference_worker is None: # Persistent, started on first use.
+            structure_recognition_module.inference_worker = inference_worker.InferenceWorker(MODEL_PRESET)
+        return structure_recognition_module.inference_worker
+    if not _model_loaded.is_set():
+        logging.info(lib_utils.log_message("Waiting for the neural network model to be loaded ..."))
+    return structure_recognition_module.model
+
+
+# Pipeline stage: recognize the structure with the neural network, set sites, foreign atoms and target sites.
+def recognize(structure_recognition_module, item):
+    manipulator = structure_recognition_module.manipulator
+
+    # ROI inference continues from the previous frame: positions of foreign atoms and target sites.
+    previous = None
+    positions = None
+    if structure_recognition_module.inference_mode == lib_inference.ROI:
+        structure_recognition_module.roi_frames += 1
+        if not item.scan_parameters_changed and manipulator.source_xdata is not None and \
+                manipulator.source_xdata.data_shape == item.xdata.data_shape and \
+                structure_recognition_module.roi_frames < lib_inference.ROI_FULL_FRAME_INTERVAL:
+            previous = structure_recognition_module.nn_output
+            positions = [atom.site.coords for atom in manipulator.sources] + \
+                        [site.coords for site in manipulator.targets]
+        if previous is None or len(positions) == 0:
+            structure_recognition_module.roi_frames = 0 # Full frame.
+
+    # The frame becomes the current frame.
+    manipulator.source_xdata = item.xdata
+    manipulator.source_title = item.title
+    manipulator.scan_parameters_changed = item.scan_parameters_changed
+
+    # Aliases.
+    shape = np.array(item.xdata.data_shape)
+
+    # Call fully convolutional neural network (FCNN).
+    t = time.time()
+    logging.info(lib_utils.log_message("Neural network called for structure recognition."))
+    
+    model = get_model(structure_recognition_module)
+    structure_recognition_module.nn_output = lib_inference.infer(model, item.xdata.data, item.sampling,
+                                                                 mode=structure_recognition_module.inference_mode,
+                                                                 positions=positions, previous=previous)
+
+    t = time.time()-t
+    logging.info(lib_utils.log_message(f"Neural network returned result after {t:.5f} seconds."))
+
+    # Done here to give the user a possibility to look at the paths. The metadata of the frame is set together with
+    # the frame, a late pathfinding stage of the previous frame does not overwrite it (see lib_pathfinding.plan_paths).
+    with manipulator.compose_lock:
+        manipulator.metadata_to_append = item.metadata
+        lib_utils.init_pdi(manipulator, item.number)
+
+    # Conditioning NN output.
+    if structure_recognition_module.nn_output is not None:
+        manipulator.maxima_locations = np.fliplr(structure_recognition_module.nn_output['points'])
+        number_maxima = len(manipulator.maxima_locations)
+    else:
+        manipulator.maxima_locations = None
+        number_maxima = 0
+        
+    logging.info(lib_utils.log_message(f"{number_maxima:d} atoms were found."))
+    
+    # Call object-oriented backend to draw atom positions and bonds.
+    t = time.time()
+    manipulator.paths = []
+    max_displacement_px = MAX_SITE_DISPLACEMENT/item.sampling
+    if manipulator.site_tracker is None:
+        manipulator.site_tracker = aab.SiteTracker(max_displacement_px)
+    tracker = manipulator.site_tracker
+    tracker.max_displacement = max_displacement_px
+    if item.scan_parameters_changed:
+        tracker.reset()
+    if number_maxima > 0:
+        lattice = aab.Lattice.from_coords(manipulator.maxima_locations)
+    else:
+        lattice = aab.Lattice.from_coords(np.empty((0, 2)))
+    N_new = tracker.track(lattice) # Assigns persistent site IDs.
+    manipulator.sites = lattice.sites
+
+    if structure_recognition_module.scale_calibration_mode == 1: # Display the live calibration of this frame.
+        structure_recognition_module.sampling = item.sampling
+        structure_recognition_module.fov = [item.sampling*s for s in item.xdata.data_shape]
+    lib_utils.refresh_GUI(manipulator, ['atoms', 'sampling'])
+
+    t = time.time()-t
+    logging.info(lib_utils.log_message(f"Setting sites (back end) finished after {t:.5f} seconds "
+                                       f"({N_new:d} new site IDs)."))
+
+    # Try to keep target sites and foreign atoms till the next frame.
+    if item.scan_parameters_changed: # re-init
+        clear_user_defined_atoms_and_targets(manipulator)
+    
+    else: # Reattach foreign atoms and target sites to the sites with the same ID, reposition graphics.
+        t = time.time()
+           
+        # Target sites (the graphic holds the site it was moved to by the user).
+        for i, target in enumerate(manipulator.targets):
+            graphic = target.graphic
+            site = tracker.lookup(getattr(graphic, 'site', target))
+            if site is None: # Site vanished, take the one nearest to the graphic.
+                site = tracker.nearest(np.array(graphic.center)*shape)
+            if site is None:
+                continue
+            manipulator.targets[i] = site
+            site.graphic = graphic
+            graphic.site = site
+        def reposition_target_site_graphics():
+            with manipulator.api.library.data_ref_for_data_item(manipulator.processed_data_item):
+                for target in manipulator.targets:
+                    target.graphic.center = target.coords / shape
+        manipulator.api.queue_task(reposition_target_site_graphics)
+         
+        # Foreign atoms (only user-defined).
+        atoms_user_def = []
+        for atom in manipulator.sources:
+            if atom.defined_by_user: atoms_user_def.append(atom)
             
-                # Try to keep target sites and foreign atoms till the next frame.
-                if manipulator.scan_parameters_changed: # re-init
-                    clear_user_defined_atoms_and_targets(manipulator)
-                
-                else: # Reposition foreign atoms, target sites and the corresponding graphics.
-                    t = time.time()
-
-                    all_coords = np.full((len(manipulator.sites), 2), np.nan)
-                    if len(manipulator.sources) > 0 or len(manipulator.targets) > 0:
-                        for i, site in enumerate(manipulator.sites):
-                            all_coords[i, :] = site.coords
-                    else:
-                        pass
-                       
-                    # Target sites.
-                    graphics_pos = np.full((len(manipulator.targets), 2), np.nan)
-                    for i, target in enumerate(manipulator.targets):
-                        graphics_pos[i, :] = target.graphic.center
-                    graphics_pos *= shape
-                        
-                    distances = np.linalg.norm(graphics_pos - all_coords[:, np.newaxis, :], axis=2)
-                    site_indices = np.argmin(distances, axis=0)
-                    
-                    for i, site_index in enumerate(site_indices):
-                        graphic = manipulator.targets[i].graphic
-                        manipulator.targets[i] = manipulator.sites[site_index]
-                        manipulator.targets[i].graphic = graphic
-                    def reposition_target_site_graphics():
-                        with manipulator.api.library.data_ref_for_data_item(manipulator.processed_data_item):
-                            for target in manipulator.targets:
-                                target.graphic.center = target.coords / shape
-                    manipulator.api.queue_task(reposition_target_site_graphics)
-                     
-                    # Foreign atoms (only user-defined).
-                    atoms_user_def = []
-                    for atom in manipulator.sources:
-                        if atom.defined_by_user: atoms_user_def.append(atom)
-                        
-                    graphics_pos = np.full((len(atoms_user_def), 2), np.nan)
-                    for i, atom in enumerate(atoms_user_def):
-                        graphics_pos[i, :] = atom.graphic.center
-                    graphics_pos *= shape
-                        
-                    distances = np.linalg.norm(graphics_pos - all_coords[:, np.newaxis, :], axis=2)
-                    site_indices = np.argmin(distances, axis=0)
-                    
-                    for i, site_index in enumerate(site_indices):
-                        atoms_user_def[i].site = manipulator.sites[site_index]
-                        atoms_user_def[i].origin = manipulator.sources[i].site
-
-                    def reposition_foreign_atom_graphics():
-                        with manipulator.api.library.data_ref_for_data_item(manipulator.processed_data_item):
-                            for atom in atoms_user_def:
-                                atom.graphic.center = atom.origin.coords / shape
-                    manipulator.api.queue_task(reposition_foreign_atom_graphics)
-                    
-                    t = time.time()-t
-                    
-                    logging.info(lib_utils.log_message(f"Repositioning of foreign atoms, target sites, "
-                                                       f"and graphics finished after {t:.5f} seconds."))
-                
-                # Auto-detection of sources.
-                func_auto_detect_foreign_atoms(structure_recognition_module)
+        for atom in atoms_user_def:
+            site = tracker.lookup(atom.origin)
+            if site is None: # Site vanished, take the one nearest to the graphic.
+                site = tracker.nearest(np.array(atom.graphic.center)*shape)
+            if site is None:
+                continue
+            atom.site = site
+            atom.origin = site
 
-                # Wait for ready_init_pdi event.
-                while not manipulator.rdy_init_pdi.wait(1):
-                    pass
-                
-                # Draw atom positions if checkbox is checked.
-                tmp_image = copy.copy(pdi.data)
-                if structure_recognition_module.visualize_atoms:
-                    lib_utils.plot_points(tmp_image, manipulator.maxima_locations)
+        def reposition_foreign_atom_graphics():
+            with manipulator.api.library.data_ref_for_data_item(manipulator.processed_data_item):
+                for atom in atoms_user_def:
+                    atom.graphic.center = atom.origin.coords / shape
+        manipulator.api.queue_task(reposition_foreign_atom_graphics)
+        
+        t = time.time()-t
+        
+        logging.info(lib_utils.log_message(f"Repositioning of foreign atoms, target sites, "
+                                           f"and graphics finished after {t:.5f} seconds."))
+    
+    # Auto-detection of sources.
+    func_auto_detect_foreign_atoms(structure_recognition_module, item.sampling)
 
-                # Append timestamp to metadata.
-                manipulator.metadata_to_append['timestamp_2_structure_recognition_finished'] = time.time()
-                
-                # Update data item.
-                manipulator.rdy_update_pdi.clear()
-                lib_utils.update_pdi(manipulator, tmp_image)               
+    # Wait for ready_init_pdi event.
+    manipulator.rdy_init_pdi.wait()
+    
+    # Draw atom positions if checkbox is checked.
+    if structure_recognition_module.visualize_atoms and manipulator.maxima_locations is not None:
+        manipulator.overlay.set_layer('atoms', *lib_utils.points_pixels(manipulator.maxima_locations),
+                                      lib_utils.ATOMS_COLOR)
+    else:
+        manipulator.overlay.clear_layer('atoms')
 
-                # Trigger ready-event.
-                structure_recognition_module.rdy.set() 
-                
-                # Integrate pathfinding in live analysis.
-                if live_analysis and (len(manipulator.sources)>=0 and len(manipulator.targets)>=0):
-                    lib_pathfinding.find_paths(manipulator)
-                
-        if auto_manipulate:
-            logging.info(lib_utils.log_message("Structure recognition stopped."))
+    # Append timestamp to metadata.
+    metadata = dict(item.metadata, timestamp_2_structure_recognition_finished=time.time())
+    manipulator.metadata_to_append = metadata
+    
+    # Update data item.
+    lib_utils.update_pdi(manipulator, lib_utils.compose_overlay(manipulator))
 
-    # Run in other thread. 
-    manipulator.t1 = threading.Thread(target = do_this, name = 'do_this')
-    manipulator.t1.start()
+    # Trigger ready-event.
+    structure_recognition_module.rdy.set() 
+
+    # Foreign atoms and target sites of this frame, later frames do not change them.
+    sources, targets = lib_pathfinding.frame_sources_and_targets(manipulator)
+    return item._replace(metadata=metadata, sites=manipulator.sites, sources=sources, targets=targets)
 
             
 # Auto-detect and display foreign atoms.
-def func_auto_detect_foreign_atoms(structure_recognition_module):
+# sampling ... of the current frame (in Angstroem/px), for element identification
+def func_auto_detect_foreign_atoms(structure_recognition_module, sampling):
     # Aliases.
     manipulator = structure_recognition_module.manipulator
     rra = manipulator.rectangle_regions_auto
@@ -295,9 +469,9 @@ def func_auto_detect_foreign_atoms(structure_recognition_module):
     relative_size = 0.05
     number_foreigns = len(foreigns_site_id)
     
-    while not manipulator.rdy_update_pdi.wait(1):
+    if not manipulator.rdy_update_pdi.wait(1):
         logging.info(lib_utils.log_message("Waiting for an update of the processed data item..."))
-        pass
+        manipulator.rdy_update_pdi.wait()
     
     new_centers = []    
     for i in range(number_foreigns):
@@ -337,7 +511,7 @@ def func_auto_detect_foreign_atoms(structure_recognition_module):
     # The following is threaded out, because it is not needed for later processes.
     def do_this(): 
         lib_utils.refresh_GUI(manipulator, ['foreigns'])
-        lib_utils.element_identification(manipulator)
+        lib_utils.element_identification(manipulator, sampling)
     threading.Thread(target=do_this).start()
 
 
@@ -9,21 +9,27 @@ import copy
 import logging
 
 import math
+import functools
 import string
 
-from matplotlib import colors as mcolors
-from skimage import draw
-
-# Non-standard packages
-try:
-    from periodictable import elements as pt_elements # Optional
-except:
-    pass
-from double_gaussian_blur import dgb
+# Non-standard packages (double_gaussian_blur, periodictable) are imported on first use.
 
 _ = gettext.gettext
 
 
+# Maximum number of pixels gathered at once by integrate_intensities.
+INTEGRATION_CHUNK_SIZE = 1 << 20
+
+# Overlay colors (RGB).
+ATOMS_COLOR = (255, 165, 0)
+PATHS_COLOR = (0, 165, 255)
+
+# Element identification.
+ELEMENT_ID_SIGMA1 = 0.25  # in Angstroem, sigma of the first Gaussian of the double Gaussian blur (sigma2 = 3*sigma1)
+ELEMENT_ID_CONTEXT = 6.   # in Angstroem, around foreign atoms, includes carbon atoms as intensity reference
+DGB_TRUNCATE = 4.         # in sigma, range of the blur considered in padded patches
+
+
 # Convert two-dimensional indices to one-dimensional index.
 def sub2ind(rows, cols, array_shape):
     return rows * array_shape[1] + cols
@@ -54,37 +60,82 @@ class AtomManipulatorModule(object):
         raise NotImplementedError()
 
 
+# Offsets of the pixels of a disk with radius {radius} (pixel centers strictly inside, as skimage.draw.disk).
+@functools.lru_cache(maxsize=8)
+def disk_stencil(radius):
+    r = int(math.ceil(radius))
+    i, j = np.mgrid[-r:r+1, -r:r+1]
+    inside = (i/radius)**2 + (j/radius)**2 < 1
+    return i[inside], j[inside]
+
+
+# Sets the pixels (rows, cols) inside the image to color, pixels outside are clipped.
+def set_pixels(image, rows, cols, color):
+    in_image = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+    image[rows[in_image], cols[in_image]] = color
+
+
+# Pixels of lines between (r0, c0) and (r1, c1) (integer arrays) with Bresenham's algorithm, as skimage.draw.line.
+def lines(r0, c0, r1, c1):
+    dr = np.abs(r1-r0)
+    dc = np.abs(c1-c0)
+    sr = np.where(r1-r0 > 0, 1, -1)
+    sc = np.where(c1-c0 > 0, 1, -1)
+    steep = dr > dc
+    major, minor = np.maximum(dr, dc), np.minimum(dr, dc)
+
+    # Step i along the major axis of each line; the last pixel is the end point.
+    length = major+1
+    line = np.repeat(np.arange(len(r0)), length)
+    i = np.arange(length.sum()) - np.repeat(np.cumsum(length)-length, length)
+    major, minor = major[line], minor[line]
+    # Number of steps along the minor axis before pixel i (closed form of the error term of the algorithm).
+    k = np.maximum(0, (2*minor*i - major) // np.maximum(2*major, 1) + 1)
+    steep = steep[line]
+    rows = r0[line] + sr[line]*np.where(steep, i, k)
+    cols = c0[line] + sc[line]*np.where(steep, k, i)
+    end = i == major
+    rows[end] = r1[line][end]
+    cols[end] = c1[line][end]
+    return rows, cols
+
+
+# Pixels (rows, cols) of disks around points (N x 2), not clipped to the image.
+def points_pixels(points, size=3):
+    points = np.round(np.asarray(points)).astype(int).reshape(-1, 2)
+    di, dj = disk_stencil(size)
+    return (points[:, 0, np.newaxis] + di).ravel(), (points[:, 1, np.newaxis] + dj).ravel()
+
+
+# Pixels (rows, cols) of the shortened path segments, not clipped to the image.
+def paths_pixels(paths):
+    segments = [(path.sitelist[i].coords, path.sitelist[i+1].coords)
+                for path in paths.members for i in range(len(path.sitelist)-1)]
+    if len(segments) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    segments = np.array(segments, dtype=float)
+    y1, x1 = segments[:, 0, 0], segments[:, 0, 1]
+    y2, x2 = segments[:, 1, 0], segments[:, 1, 1]
+    # Shorten the display of the bond.
+    w = 1/5 # Weight of position A.
+    y1 = (y1*(1-w) + y2*w).round().astype(int)
+    x1 = (x1*(1-w) + x2*w).round().astype(int)
+    y2 = (y1*w + y2*(1-w)).round().astype(int) # Weighted with the shortened position A.
+    x2 = (x1*w + x2*(1-w)).round().astype(int)
+    return lines(y1, x1, y2, x2)
+
+
 # Insert points into image.
 def plot_points(image, points, size=3, color="blue"):
     if points is None:
         return image
-    color = (255, 165, 0)
-    points = np.round(points).astype(int)
-    for point in points:
-        try:
-            image[draw.disk((point[0], point[1]), size, shape=image.shape)] = color
-        except IndexError:
-            pass
+    set_pixels(image, *points_pixels(points, size), ATOMS_COLOR)
     return image     
 
 
 # Insert paths into image.
 def plot_paths(image, paths):
-    color = (0, 165, 255)
-    for path in paths.members:
-        for i in range(len(path.sitelist)-1):
-            y1, x1 = path.sitelist[i].coords
-            y2, x2 = path.sitelist[i+1].coords
-            # Shorten the display of the bond.
-            w = 1/5 # Weight of position A.
-            y1 = (y1*(1-w) + y2*w).round().astype(int)
-            x1 = (x1*(1-w) + x2*w).round().astype(int)
-            y2 = (y1*w + y2*(1-w)).round().astype(int)
-            x2 = (x1*w + x2*(1-w)).round().astype(int)
-            try:
-                image[draw.line(y1, x1, y2, x2)] = color
-            except:
-                pass
+    set_pixels(image, *paths_pixels(paths), PATHS_COLOR)
     return image
 
 
@@ -128,26 +179,59 @@ def create_pdi(manipulator):
             pass                                                                       
         manipulator.processed_data_item = manipulator.document_controller.create_data_item_from_data_and_metadata(
                            xdata, title=_('[LIVE] ') + ('AtomManipulator_') + _('dummy'))
+        manipulator.pdi_metadata = None
         manipulator.rdy_create_pdi.set()
         manipulator.clear_manipulator_objects()
         refresh_GUI(manipulator, ['atoms', 'foreigns', 'targets'])
     manipulator.api.queue_task(func)
 
 
+# Composes the overlays of the processed data item (see lib_overlay) in the calling thread and returns the buffer for
+# update_pdi. The compositor writes to the buffer set on the data item before the last one, so the update task of the
+# last buffer must have been run. Composing waits for it, the next compose waits for the update of this buffer.
+# Callers holding compose_lock (reentrant) can check the frame shown (overlay.frame_number) and change the layers and
+# the metadata to append for it atomically, before composing.
+# new_frame ... data of a new frame (normalized to the base of the overlays before composing)
+# number ... number of the new frame
+def compose_overlay(manipulator, new_frame=None, number=None):
+    with manipulator.compose_lock:
+        manipulator.rdy_update_pdi.wait()
+        if new_frame is not None:
+            manipulator.overlay.set_frame(new_frame, number)
+        manipulator.rdy_update_pdi.clear() # Set by the update task (update_pdi, init_pdi).
+        return manipulator.overlay.compose()
+
+
 # GUI task function to be called after new image has been read.
-def init_pdi(manipulator):
+# number ... number of the new frame (see lib_pipeline.FrameItem)
+def init_pdi(manipulator, number=None):
+    source = manipulator.source_xdata
+
+    # The raw data is shared read-only with the source.
+    data = np.asarray(source.data).view()
+    data.flags.writeable = False
+
+    # Convert data to RGB values (into the preallocated base of the overlays).
+    new_data = compose_overlay(manipulator, new_frame=data, number=number)
+    metadata_to_append = manipulator.metadata_to_append # Of this frame, at the time of composing.
+    manipulator.rdy_init_pdi.clear() # Only now, the update task composing waited for may wait for this event.
+
     def func():
         if manipulator.processed_data_item not in manipulator.api.library.data_items:
             manipulator.rdy_create_pdi.clear()
             create_pdi(manipulator)
-        while not manipulator.rdy_create_pdi.wait(1):
-            pass # Waiting for creation of processed_data_item.
+        manipulator.rdy_create_pdi.wait() # Waiting for creation of processed_data_item.
         manipulator.processed_data_item.title = _('[LIVE] ') + 'AtomManipulator_' + manipulator.source_title
-        xdata = copy.deepcopy(manipulator.source_xdata)
-        xdata.metadata[manipulator.metadata_root_key] = manipulator.metadata_to_append
+
+        # Only the top level of the metadata is copied.
+        metadata = dict(source.metadata)
+        metadata[manipulator.metadata_root_key] = copy.deepcopy(metadata_to_append)
         
         # Snapshot RAW data if checkbox is checked
         if manipulator.snapshot_counter is not None:
+            xdata = manipulator.api.create_data_and_metadata(data, source.intensity_calibration,
+                                                             source.dimensional_calibrations, metadata,
+                                                             source.timestamp, source.data_descriptor)
             manipulator.processed_data_item.set_data_and_metadata(xdata)
             with manipulator.api.library.data_ref_for_data_item(manipulator.processed_data_item):
                 sdi = manipulator.api.library.snapshot_data_item(manipulator.processed_data_item)
@@ -155,34 +239,44 @@ def init_pdi(manipulator):
                           ' RAW_' + manipulator.source_title)
             manipulator.snapshot_counter += 1
 
-        # Convert data to RGB values, save original data as well as rgb data in data item
-        data = np.array(xdata.data)
+        # Keep the original data as well
         manipulator.processed_data_item.original_data = data
-        manipulator.processed_data_item.rgb_data = np.tile(
-            ((data - data.min()) / data.ptp() * 255).astype(np.uint8)[..., None], (1, 1, 3))
         
         # Set data and metadata of data item
-        manipulator.processed_data_item.set_data(manipulator.processed_data_item.rgb_data)
-        manipulator.processed_data_item.set_metadata(xdata.metadata)
+        if new_data is not None:
+            manipulator.processed_data_item.set_data(new_data)
+        manipulator.processed_data_item.set_metadata(metadata)
+        manipulator.pdi_metadata = metadata
 
         manipulator.rdy_init_pdi.set()
+        manipulator.rdy_update_pdi.set()
     manipulator.api.queue_task(func)
 
 
 # GUI task function for updating the data in the processed_data_item.
+# new_data ... None if only the metadata changed
 def update_pdi(manipulator, new_data):
+    metadata_to_append = manipulator.metadata_to_append # Matching new_data, may change before the task is run.
+
     def func():
         if manipulator.processed_data_item not in manipulator.api.library.data_items:
             manipulator.rdy_init_pdi.clear()
             init_pdi()
-        while not manipulator.rdy_init_pdi.wait(1):
-            pass
-
-        metadata = copy.deepcopy(manipulator.processed_data_item.metadata)
-        metadata[manipulator.metadata_root_key] = manipulator.metadata_to_append
-        
-        manipulator.processed_data_item.set_data(new_data)
-        manipulator.processed_data_item.set_metadata(metadata)
+        manipulator.rdy_init_pdi.wait()
+
+        if new_data is not None:
+            manipulator.processed_data_item.set_data(new_data)
+
+        # Only the AtomManipulator entry changes, the rest (scan and hardware metadata of the source) is shared
+        # with the metadata last written. Nothing is written if the entry did not change.
+        root_key = manipulator.metadata_root_key
+        if manipulator.pdi_metadata is None:
+            manipulator.pdi_metadata = manipulator.processed_data_item.metadata
+        if manipulator.pdi_metadata.get(root_key) != metadata_to_append:
+            metadata = dict(manipulator.pdi_metadata)
+            metadata[root_key] = copy.deepcopy(metadata_to_append)
+            manipulator.processed_data_item.set_metadata(metadata)
+            manipulator.pdi_metadata = metadata
         
         manipulator.rdy_update_pdi.set()
     manipulator.api.queue_task(func)
@@ -210,13 +304,15 @@ def add_listener_graphic_changed(manipulator, graphic):
 
 
 # Element identification.
-def element_identification(manipulator):
+# sampling ... of the frame the sites belong to (in Angstroem/px)
+def element_identification(manipulator, sampling):
     # Calculate intensity values.
-    while not manipulator.rdy_create_pdi.wait(1) or not manipulator.rdy_init_pdi.wait(1) or not manipulator.rdy_update_pdi.wait(1):
-        pass # waiting for tasks on processed_data_item to be completed
+    # Waiting for tasks on processed_data_item to be completed.
+    manipulator.rdy_create_pdi.wait()
+    manipulator.rdy_init_pdi.wait()
+    manipulator.rdy_update_pdi.wait()
     
     # Aliases.
-    sampling = manipulator.structure_recognition_module.sampling
     labels = manipulator.structure_recognition_module.nn_output['labels']
     int_radius_A = manipulator.structure_recognition_module.element_id_int_radius
     Z_exponent = manipulator.structure_recognition_module.element_id_exponent
@@ -226,15 +322,17 @@ def element_identification(manipulator):
         print("Element identfication cannot be perfomed, because there is no sampling value [Angstroem/px] available.")
         return
 
-    sigma1 = 0.25 # in Angstroem
-    sigma1 /= sampling
-    data = dgb(manipulator.processed_data_item.original_data, sigma1=sigma1, sigma2=3*sigma1, weight2=0.4)
-               
-    intensities = integrate_intensities(data, manipulator.maxima_locations,
-                integration_radius = int_radius_A/sampling
-                )
+    # Only the foreign atoms and the carbon atoms around them are evaluated.
+    intensities = integrate_blurred_intensities(manipulator.processed_data_item.original_data,
+                                                manipulator.maxima_locations,
+                                                [atom.site.index for atom in manipulator.sources],
+                                                sampling, int_radius_A)
     mean_intensity_carbon = np.nanmean( intensities[labels == 0] )
     Z_carbon = 6
+    try:
+        from periodictable import elements as pt_elements # Optional
+    except ImportError:
+        pt_elements = None
         
     labels = []
     graphics = []
@@ -242,7 +340,7 @@ def element_identification(manipulator):
         if atom.defined_by_user:
             #continue
             pass
-        intensity = intensities[atom.site.id]
+        intensity = intensities[atom.site.index]
         if math.isnan(intensity):
             labels.append( "n.a." )
         else:
@@ -259,17 +357,87 @@ def element_identification(manipulator):
             pass
     manipulator.api.queue_task(func)
 
+
+# Geometry of the patches for element identification (in px), cached per sampling.
+# Returns sigma1, the margin needed by the blur and integration, and the margin including the context.
+@functools.lru_cache(maxsize=8)
+def blur_patch_geometry(sampling, integration_radius_A):
+    sigma1 = ELEMENT_ID_SIGMA1/sampling
+    reach = int(math.ceil(DGB_TRUNCATE*3*sigma1 + integration_radius_A/sampling)) + 1 # sigma2 = 3*sigma1
+    margin = reach + int(math.ceil(ELEMENT_ID_CONTEXT/sampling))
+    return sigma1, reach, margin
+
+
+# Double Gaussian blur and integration restricted to padded patches around the sites {site_indices}.
+# Overlapping patches are merged. All sites in the inner region of a patch ({reach} px from inner patch borders)
+# are evaluated, including the carbon atoms around the given sites used as reference. Other sites are NaN.
+# The background is the minimum of the blurred inner regions (instead of the whole blurred frame).
+def integrate_blurred_intensities(data, maxima_locations, site_indices, sampling, integration_radius_A):
+    from double_gaussian_blur import dgb
+    data = np.asarray(data)
+    maxima_locations = np.asarray(maxima_locations, dtype=float).reshape(-1, 2)
+    shape = np.array(data.shape[:2])
+    sigma1, reach, margin = blur_patch_geometry(sampling, integration_radius_A)
+
+    intensities = np.full(len(maxima_locations), np.nan)
+    if len(site_indices) == 0:
+        return intensities
+
+    # Patches [row0, row1, col0, col1], merged while any two overlap.
+    loc = np.array(maxima_locations[site_indices]+0.5, dtype=int)
+    lower = np.clip(loc-margin, 0, shape)
+    upper = np.clip(loc+margin+1, 0, shape)
+    boxes = [[a[0], b[0], a[1], b[1]] for a, b in zip(lower, upper)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    all_loc = np.array(maxima_locations+0.5, dtype=int)
+    patches = []
+    for r0, r1, c0, c1 in boxes:
+        # Inner region: the blur is valid there (at image borders, the border is the same as for the full frame).
+        lo = np.array([r0+reach if r0 > 0 else 0, c0+reach if c0 > 0 else 0])
+        hi = np.array([r1-reach if r1 < shape[0] else shape[0], c1-reach if c1 < shape[1] else shape[1]])
+        inner = np.nonzero(np.all((all_loc >= lo) & (all_loc < hi), axis=1))[0]
+        if len(inner) == 0:
+            continue
+        patch = dgb(data[r0:r1, c0:c1], sigma1=sigma1, sigma2=3*sigma1, weight2=0.4)
+        patches.append((patch, (r0, c0), inner, np.min(patch[lo[0]-r0:hi[0]-r0, lo[1]-c0:hi[1]-c0])))
+
+    if len(patches) > 0:
+        background = min(x[3] for x in patches)
+        for patch, origin, inner, _ in patches:
+            intensities[inner] = integrate_intensities(patch, maxima_locations[inner]-origin,
+                                                       integration_radius=integration_radius_A/sampling,
+                                                       background=background)
+    return intensities
+
+
 # Helper function for element identification
-def integrate_intensities(data, maxima_locations, integration_radius=1):
+def integrate_intensities(data, maxima_locations, integration_radius=1, background=None):
     # data ... image data (numpy.ndarray)
     # integration_radius ... (scalar)
     # maxima_locations ... (N x 2 numpy.ndarray)
+    # background ... subtracted intensity (scalar), default: minimum of data
+    # All maxima are integrated at once by gathering the pixels of a precomputed disk stencil.
+    # At the image borders, the mean is taken over the part of the disk inside the image.
 
     # Conditioning of inputs.
     if type(data) is not np.ndarray:
         data = np.array(data)
     if type(maxima_locations) is not np.ndarray:
         maxima_locations = np.array(maxima_locations)
+    maxima_locations = maxima_locations.reshape(-1, 2)
 
     # Aliases.
     shape = data.shape
@@ -277,33 +445,36 @@ def integrate_intensities(data, maxima_locations, integration_radius=1):
     
     # Init array for intensity values.
     values = np.full(N, np.nan)
+    if N == 0:
+        return values
     
-    # Create mask.
+    # Disk stencil (offsets of the pixels within the integration radius).
     integration_radius_floor = math.floor(integration_radius) # integer value; NOT making area of integration smaller.
-    M = 2*integration_radius_floor + 1
-    mask = np.ones((M, M))
-    for i in range(-integration_radius_floor, integration_radius_floor+1):
-        for j in range(-integration_radius_floor, integration_radius_floor+1):
-            if math.sqrt(i**2 + j**2) > integration_radius:
-                mask[i+integration_radius_floor, j+integration_radius_floor] = np.nan
+    i, j = np.mgrid[-integration_radius_floor:integration_radius_floor+1,
+                    -integration_radius_floor:integration_radius_floor+1]
+    inside = np.sqrt(i**2 + j**2) <= integration_radius
+    di = i[inside]
+    dj = j[inside]
     
-    # Background subtraction.
-    intensity_min = np.min(data)
-    data_shifted = data - intensity_min
+    # Background subtraction (applied to the means).
+    intensity_min = np.min(data) if background is None else background
+    data_flat = data.ravel()
     
-    for i in range(N):
-        # Location of a maximum.
-        loc = np.array(maxima_locations[i,:]+0.5, dtype=int) # Integer values; pixel position in the image.
-        
-        # Check if integration range is non-negative and smaller than shape, no try-block.
-        lower = loc-integration_radius_floor
-        upper = loc+integration_radius_floor+1
-        if any(lower < 0) or any(upper > np.array(shape)):
-            #TODO For now, just skip that
-            continue
-        else: # Do the integration.
-            tmp = data_shifted[lower[0]:upper[0], lower[1]:upper[1]] # Shift minimum to 0.
-            values[i] = np.nanmean( tmp*mask )
+    # Location of the maxima, integer values; pixel position in the image.
+    loc = np.array(maxima_locations+0.5, dtype=int)
+
+    # Integrate in chunks of at most INTEGRATION_CHUNK_SIZE pixels.
+    chunk = max(1, INTEGRATION_CHUNK_SIZE // len(di))
+    for start in range(0, N, chunk):
+        rows = loc[start:start+chunk, 0, np.newaxis] + di
+        cols = loc[start:start+chunk, 1, np.newaxis] + dj
+        in_image = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        pixels = np.where(in_image, data_flat[np.where(in_image, rows*shape[1] + cols, 0)], np.nan)
+        is_valid = ~np.isnan(pixels)
+        count = is_valid.sum(axis=1)
+        total = np.where(is_valid, pixels, 0).sum(axis=1)
+        np.divide(total, count, out=values[start:start+chunk], where=count > 0)
+    values -= intensity_min
             
     return values
 
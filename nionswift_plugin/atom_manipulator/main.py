@@ -10,6 +10,7 @@ from .gui_manipulation import ManipulationModule
 
 # Custom libraries.
 from . import lib_utils
+from . import lib_overlay
 from .lib_widgets import ScrollArea, push_button_template
 
 _ = gettext.gettext
@@ -44,6 +45,7 @@ class AtomManipulatorDelegate:
         ## Objects internal to the plug-in.
         # GUI elements.
         self.simulation_mode = None
+        self.structure_recognition_module = None # Created with the panel widget.
 
         # General control.
         self.scan_parameters_changed = None # During execution, this is True or False.
@@ -55,7 +57,12 @@ class AtomManipulatorDelegate:
         # Metadata to append.
         self.metadata_root_key = "AtomManipulator"
         self.metadata_to_append = None
+        self.pdi_metadata = None # Metadata last written to the processed data item.
         
+        # Overlays (atoms, paths) of the processed data item.
+        self.overlay = lib_overlay.OverlayCompositor()
+        self.compose_lock = threading.RLock() # See lib_utils.compose_overlay.
+
         # Graphics objects.
         self.point_regions = []
         self.line_regions = []
@@ -69,6 +76,9 @@ class AtomManipulatorDelegate:
         self.targets = []
         self.bonds = None
         self.paths = None
+        self.site_tracker = None # Persistent site IDs across frames.
+        self.plan_cache = None # Planned paths, reused while the lattice near them is unchanged.
+        self.path_pool = None # Worker processes for the parallel evaluation of direct paths.
         
         # Threads.
         self.t1 = None
@@ -93,6 +103,9 @@ class AtomManipulatorDelegate:
         self.targets = []
         self.bonds = None
         self.paths = None
+        self.site_tracker = None
+        self.plan_cache = None
+        self.close_workers()
         self.listeners = []
         self.point_regions = []
         self.line_regions = []
@@ -100,6 +113,20 @@ class AtomManipulatorDelegate:
         self.rectangle_regions_auto = []
         self.ellipse_regions = []
 
+    # Stops the worker processes, they are started again on first use.
+    def close_workers(self):
+        if self.path_pool is not None:
+            self.path_pool.close()
+            self.path_pool = None
+        srm = self.structure_recognition_module
+        if srm is not None and srm.inference_worker is not None:
+            srm.inference_worker.close()
+            srm.inference_worker = None
+
+    # Called by Nion Swift when the panel is closed.
+    def close(self):
+        self.close_workers()
+
     # Obligatory widget method for Nion Swift plug-ins.
     def create_panel_widget(self, ui, document_controller):
         self.ui = ui
@@ -158,10 +185,13 @@ class AtomManipulatorExtension(object):
         # Grab the API object.
         api = api_broker.get_api(version='~1.0', ui_version='~1.0')
         # Be sure to keep a reference or it will be closed immediately.
-        self.__panel_ref = api.create_panel(AtomManipulatorDelegate(api))
+        self.__delegate = AtomManipulatorDelegate(api)
+        self.__panel_ref = api.create_panel(self.__delegate)
   
     def close(self):
         # Close will be called when the extension is unloaded. In turn, close any references so they get closed.
         # This is not strictly necessary since the references will be deleted naturally when this object is deleted.
         self.__panel_ref.close()
-        self.__panel_ref = None
\ No newline at end of file
+        self.__panel_ref = None
+        self.__delegate.close() # Worker processes and their shared memory.
+        self.__delegate = None
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Tests of bond building (classes/atoms_and_bonds.py) on synthetic graphene lattices, without Nion Swift.
+
+Usage (from the root folder of this package):
+    $ python3 -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Import the back-end classes without loading the Nion Swift plug-in itself.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nionswift_plugin', 'atom_manipulator'))
+from classes import atoms_and_bonds as aab
+
+SAMPLING = 0.1 # Angstroem/px
+
+
+# Graphene lattice with Gaussian position noise (in Angstroem) and a fraction of vacancies, in px.
+def graphene_coords(N_sites, noise=0.05, vacancies=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    a = 1.42
+    n = int(np.ceil(np.sqrt(N_sites/2)))
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    origins = np.stack((1.5*a*(i+j), np.sqrt(3)/2*a*(i-j)), axis=-1).reshape(-1, 2)
+    coords = np.concatenate((origins, origins + (a, 0)))[:N_sites]
+    coords = coords + rng.normal(0, noise, coords.shape)
+    coords = coords[rng.random(len(coords)) >= vacancies]
+    return coords/SAMPLING
+
+
+def sites_of(coords):
+    return [aab.Site(x, y) for x, y in coords]
+
+
+# Consecutive frames: position jitter, a few vanished and new sites, and a shuffled site order.
+def frames(coords, noise, N_frames, seed=1):
+    rng = np.random.default_rng(seed)
+    for k in range(N_frames):
+        frame = coords + rng.normal(0, noise/SAMPLING, coords.shape)
+        frame = frame[rng.random(len(frame)) >= 0.002]
+        new = rng.uniform(coords.min(axis=0), coords.max(axis=0), (3, 2))
+        frame = np.concatenate((frame, new))
+        if k % 3 == 2:
+            frame = frame[rng.permutation(len(frame))]
+        yield frame
+
+
+# Lattices with contested bonds: a large position noise, or a max. bond length close to the second-nearest
+# neighbor distance (2.46 A).
+@pytest.mark.parametrize('selection', ['sweeps', 'single_pass'])
+@pytest.mark.parametrize('noise, max_bond_length', [(0.02, 2.2), (0.05, 2.2), (0.15, 2.2), (0.02, 2.6)])
+def test_update_equals_rebuild(selection, noise, max_bond_length):
+    coords = graphene_coords(3000, noise=noise)
+    L = max_bond_length/SAMPLING
+    bonds = aab.Bonds(sites_of(coords), L, selection=selection, incremental=True)
+    for frame in frames(coords, noise, 8):
+        bonds.update(sites_of(frame))
+        rebuilt = aab.Bonds(sites_of(frame), L, selection=selection)
+        assert np.array_equal(bonds.lattice.pairs, rebuilt.lattice.pairs)
+
+
+def bond_set(bonds):
+    return set(map(frozenset, bonds.tolist()))
+
+
+# The single pass selects the same bonds as the sweeps, also where the rules bind (noisy lattices, contested
+# bonds) and for any site order (the result of the sweeps depends on it).
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('noise, max_bond_length', [(0.02, 2.2), (0.05, 2.2), (0.15, 2.2), (0.3, 2.2),
+                                                    (0.02, 2.6), (0.3, 2.6), (0.3, 3.0)])
+def test_single_pass_equals_sweeps(noise, max_bond_length, seed, shuffle):
+    coords = graphene_coords(3000, noise=noise, seed=seed)
+    if shuffle:
+        coords = coords[np.random.default_rng(seed).permutation(len(coords))]
+    pairs = aab.Bonds.candidate_pairs(coords, max_bond_length/SAMPLING)
+    bonds_sweeps = aab.Bonds.select_bonds_sweeps(coords, pairs)
+    bonds_single = aab.Bonds.select_bonds(coords, pairs)
+    assert len(bonds_single) == len(bonds_sweeps)
+    assert bond_set(bonds_single) == bond_set(bonds_sweeps)